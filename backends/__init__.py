@@ -0,0 +1,41 @@
+"""
+backends 包提供存储后端的统一接口。models 中的密文、签名与断点续传暂存的块都通过 get_backend()
+返回的后端读写，不直接访问文件系统。对象用相对于存储根目录的位置（location）表示，例如 'c/ab/cd/<哈希值>'。
+
+LocalBackend 把对象保存在本地目录 storage_path 中，是默认的后端；
+S3Backend 把对象保存在 S3 兼容的对象存储（AWS S3、MinIO 等）中，多个 Web 节点共享同一个存储桶即可水平扩展，
+加密与签名仍然在服务器端完成，对象存储中只有密文。
+使用哪个后端由 config 中的 storage_backend 决定。
+"""
+
+from threading import Lock
+from .base import Backend
+from .local import LocalBackend
+
+_backend = None
+_backend_lock = Lock()
+
+
+# 返回当前进程使用的存储后端，第一次调用时按配置创建
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _create_backend()
+    return _backend
+
+
+def _create_backend():
+    from config import storage_backend
+    if storage_backend == 's3':
+        # boto3 只有使用 S3 后端时才需要安装
+        from .s3 import S3Backend
+        from config import s3_bucket, s3_prefix, s3_endpoint_url, s3_access_key, s3_secret_key, \
+            s3_region, s3_max_connections, s3_part_size, s3_read_size
+        return S3Backend(s3_bucket, s3_prefix, s3_endpoint_url, s3_access_key, s3_secret_key,
+                         s3_region, s3_max_connections, s3_part_size, s3_read_size)
+    assert storage_backend == 'local', 'unknown storage backend ({})'.format(
+        storage_backend)
+    from config import storage_path, storage_fsync
+    return LocalBackend(storage_path, storage_fsync)
@@ -0,0 +1,61 @@
+class Backend:
+    """
+    存储后端的接口。子类至少实现 writer、open、size、exists、delete 与 list，
+    put、iter_range、copy 与 delete_prefix 有基于这些方法的默认实现，子类可以按需改写。
+    """
+
+    # 返回上下文管理器，得到可写入的文件对象，支持 write、tell，
+    # 以及回到已写入的开头部分修改（流式加密写完后回填头部）。
+    # 正常退出时整个对象原子地发布，读取者不会看到写了一半的对象；with 块中抛出异常时丢弃写入的数据
+    def writer(self, location):
+        raise NotImplementedError
+
+    # 打开对象，返回支持 read、seek、tell 与 close 的只读文件对象，可以用于 with 语句
+    def open(self, location):
+        raise NotImplementedError
+
+    # 对象的字节数
+    def size(self, location):
+        raise NotImplementedError
+
+    def exists(self, location):
+        raise NotImplementedError
+
+    # 删除对象，对象不存在时什么也不做
+    def delete(self, location):
+        raise NotImplementedError
+
+    # 逐个返回位置以 prefix 开头的对象
+    def list(self, prefix):
+        raise NotImplementedError
+
+    # 对象在本地文件系统中的路径，可以直接交给 send_file 零拷贝发送；不在本地时返回 None
+    def local_path(self, location):
+        return None
+
+    # 一次写入整个对象
+    def put(self, location, data):
+        with self.writer(location) as f:
+            f.write(data)
+
+    # 逐块产出对象中 [start, start+length) 区间的字节
+    def iter_range(self, location, start, length, block_size=1024*1024):
+        with self.open(location) as f:
+            f.seek(start)
+            while length > 0:
+                block = f.read(min(block_size, length))
+                if not block:
+                    break
+                length -= len(block)
+                yield block
+
+    # 把对象复制到新的位置
+    def copy(self, src, dst):
+        with self.writer(dst) as f:
+            for block in self.iter_range(src, 0, self.size(src)):
+                f.write(block)
+
+    # 删除位置以 prefix 开头的所有对象
+    def delete_prefix(self, prefix):
+        for location in list(self.list(prefix)):
+            self.delete(location)
@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+from os import path, makedirs, remove, replace, walk, link, fsync
+from shutil import rmtree
+from uuid import uuid4
+import os
+from .base import Backend
+
+
+class LocalBackend(Backend):
+    """
+    把对象保存在本地目录 root 中，对象的位置就是相对于 root 的路径。
+    多个 Web 节点使用本后端时，root 需要位于共享的文件系统上。
+    对象先写入同一目录下的临时文件，写完后改名发布，改名是原子的。
+    fsync 为 'none' 时不主动刷盘，'file' 时发布前对临时文件执行 fsync，
+    'full' 时还在发布后对所在目录执行 fsync，保证改名本身也已落盘。
+    """
+
+    def __init__(self, root, fsync='file'):
+        self.root = root
+        self.fsync = fsync
+
+    def local_path(self, location):
+        return self.root + location
+
+    @contextmanager
+    def writer(self, location):
+        file_path = self.local_path(location)
+        makedirs(path.dirname(file_path), exist_ok=True)
+        # 临时文件名带随机部分，并发写入同一位置时互不干扰
+        tmp_path = '{}.{}.tmp'.format(file_path, uuid4().hex)
+        try:
+            with open(tmp_path, 'wb') as f:
+                yield f
+                if self.fsync != 'none':
+                    f.flush()
+                    fsync(f.fileno())
+            self._publish(tmp_path, file_path)
+        finally:
+            if path.exists(tmp_path):
+                remove(tmp_path)
+
+    # 把写好的临时文件发布到最终位置
+    def _publish(self, tmp_path, file_path):
+        replace(tmp_path, file_path)
+        if self.fsync == 'full':
+            self._sync_dir(path.dirname(file_path))
+
+    @staticmethod
+    def _sync_dir(dir_path):
+        try:
+            fd = os.open(dir_path, os.O_RDONLY)
+        except OSError:
+            # Windows 上不能打开目录，改名由文件系统自己保证
+            return
+        try:
+            fsync(fd)
+        finally:
+            os.close(fd)
+
+    def open(self, location):
+        return open(self.local_path(location), 'rb')
+
+    def size(self, location):
+        return path.getsize(self.local_path(location))
+
+    def exists(self, location):
+        return path.exists(self.local_path(location))
+
+    def delete(self, location):
+        if path.exists(self.local_path(location)):
+            remove(self.local_path(location))
+
+    def list(self, prefix):
+        # prefix 以 / 结尾时只需遍历该目录，否则遍历其所在的目录再按前缀过滤
+        top = self.root + prefix
+        if not prefix.endswith('/'):
+            top = path.dirname(top)
+        for dirpath, _, filenames in walk(top):
+            for name in filenames:
+                location = path.relpath(path.join(dirpath, name), self.root).replace(path.sep, '/')
+                if location.startswith(prefix):
+                    yield location
+
+    # 同一文件系统上用硬链接复制，不需要读写数据
+    def copy(self, src, dst):
+        makedirs(path.dirname(self.local_path(dst)), exist_ok=True)
+        try:
+            link(self.local_path(src), self.local_path(dst))
+        except FileExistsError:
+            raise
+        except OSError:
+            # 不支持硬链接的文件系统
+            super().copy(src, dst)
+
+    def delete_prefix(self, prefix):
+        if prefix.endswith('/'):
+            rmtree(self.root + prefix, ignore_errors=True)
+        else:
+            super().delete_prefix(prefix)
@@ -0,0 +1,219 @@
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from .base import Backend
+
+
+class S3Backend(Backend):
+    """
+    把对象保存在 S3 兼容的对象存储中，对象的位置加上 prefix 就是对象键。
+    boto3 的客户端是线程安全的，所有线程共用一个客户端及其连接池，连接数上限为 max_connections；
+    大于 part_size 的对象分段上传，读取时按 read_size 发送区间请求。
+    对象在 PUT 或完成分段上传时才可见，本身就是原子发布的。
+    """
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, access_key=None, secret_key=None,
+                 region=None, max_connections=10, part_size=8*1024*1024, read_size=1024*1024):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = part_size
+        self.read_size = read_size
+        self.client = boto3.session.Session().client(
+            's3', endpoint_url=endpoint_url, aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key, region_name=region,
+            config=Config(max_pool_connections=max_connections, retries={'max_attempts': 3}))
+
+    def _key(self, location):
+        return self.prefix + location
+
+    def writer(self, location):
+        return S3Writer(self, self._key(location))
+
+    def put(self, location, data):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(location), Body=data)
+
+    def open(self, location):
+        return S3Reader(self, self._key(location), self.size(location))
+
+    def size(self, location):
+        return self.client.head_object(Bucket=self.bucket, Key=self._key(location))['ContentLength']
+
+    def exists(self, location):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(location))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def delete(self, location):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(location))
+
+    def list(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(prefix)):
+            for item in page.get('Contents', []):
+                yield item['Key'][len(self.prefix):]
+
+    # 一次区间请求，边接收边产出
+    def iter_range(self, location, start, length, block_size=1024*1024):
+        if length <= 0:
+            return
+        body = self.client.get_object(
+            Bucket=self.bucket, Key=self._key(location),
+            Range='bytes={}-{}'.format(start, start + length - 1))['Body']
+        try:
+            yield from body.iter_chunks(block_size)
+        finally:
+            body.close()
+
+    # 在存储端复制，大对象由 boto3 自动分段复制
+    def copy(self, src, dst):
+        self.client.copy({'Bucket': self.bucket, 'Key': self._key(src)},
+                         self.bucket, self._key(dst))
+
+    # 读取对象键 key 的 [start, start+length) 区间，供 S3Reader 使用
+    def _get_range(self, key, start, length):
+        return self.client.get_object(
+            Bucket=self.bucket, Key=key,
+            Range='bytes={}-{}'.format(start, start + length - 1))['Body'].read()
+
+
+class S3Writer:
+    """
+    写入 S3 对象的文件对象。不超过一个分段的对象在退出 with 块时用一次 PUT 上传；
+    更大的对象从第二段开始边写边分段上传，第一段留在内存中，
+    以便流式加密写完后回到开头回填头部，最后再上传第一段并完成分段上传。
+    """
+
+    def __init__(self, backend, key):
+        self._backend = backend
+        self._key = key
+        self._head = bytearray()
+        self._buffer = bytearray()
+        self._size = 0
+        self._pos = 0
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, data):
+        n = len(data)
+        if self._pos < self._size:
+            # 只能修改仍在内存中的第一段
+            assert self._pos + n <= len(self._head), 'cannot rewrite uploaded data'
+            self._head[self._pos:self._pos+n] = data
+            self._pos += n
+            return n
+        data = memoryview(data)
+        room = self._backend.part_size - len(self._head)
+        if room > 0:
+            self._head += data[:room]
+            data = data[room:]
+        self._buffer += data
+        while len(self._buffer) >= self._backend.part_size:
+            self._upload_part(bytes(self._buffer[:self._backend.part_size]))
+            del self._buffer[:self._backend.part_size]
+        self._size += n
+        self._pos = self._size
+        return n
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset):
+        assert 0 <= offset <= self._size, 'invalid offset'
+        self._pos = offset
+
+    # 分段编号从 2 开始，第 1 段在完成上传时提交
+    def _upload_part(self, data):
+        client, bucket = self._backend.client, self._backend.bucket
+        if self._upload_id is None:
+            self._upload_id = client.create_multipart_upload(
+                Bucket=bucket, Key=self._key)['UploadId']
+        number = len(self._parts) + 2
+        etag = client.upload_part(Bucket=bucket, Key=self._key, UploadId=self._upload_id,
+                                  PartNumber=number, Body=data)['ETag']
+        self._parts.append({'PartNumber': number, 'ETag': etag})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        client, bucket = self._backend.client, self._backend.bucket
+        if exc_type is not None and self._upload_id is None:
+            return False
+        # 超出第一段的数据不足一个分段时也要分段上传，只有全部数据都在第一段中时才用一次 PUT
+        if self._upload_id is None and not self._buffer:
+            client.put_object(Bucket=bucket, Key=self._key, Body=bytes(self._head))
+            return False
+        if exc_type is not None:
+            client.abort_multipart_upload(Bucket=bucket, Key=self._key, UploadId=self._upload_id)
+            return False
+        try:
+            # 剩余的数据作为最后一段，可以小于分段大小
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+                self._buffer = bytearray()
+            etag = client.upload_part(Bucket=bucket, Key=self._key, UploadId=self._upload_id,
+                                      PartNumber=1, Body=bytes(self._head))['ETag']
+            client.complete_multipart_upload(
+                Bucket=bucket, Key=self._key, UploadId=self._upload_id,
+                MultipartUpload={'Parts': [{'PartNumber': 1, 'ETag': etag}] + self._parts})
+        except Exception:
+            if self._upload_id is not None:
+                client.abort_multipart_upload(Bucket=bucket, Key=self._key,
+                                              UploadId=self._upload_id)
+            raise
+        return False
+
+
+class S3Reader:
+    """
+    读取 S3 对象的只读文件对象，支持 seek。每次按 read_size 预读一段，
+    顺序的小块读取不会各自发送一个请求；seek 到缓冲区以外时重新发送区间请求。
+    """
+
+    def __init__(self, backend, key, size):
+        self._backend = backend
+        self._key = key
+        self._size = size
+        self._pos = 0
+        self._buffer = b''
+        self._buffer_start = 0
+
+    def read(self, size=-1):
+        remaining = self._size - self._pos
+        if size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+        offset = self._pos - self._buffer_start
+        if offset < 0 or offset + size > len(self._buffer):
+            length = min(max(size, self._backend.read_size), remaining)
+            self._buffer = self._backend._get_range(self._key, self._pos, length)
+            self._buffer_start, offset = self._pos, 0
+        data = self._buffer[offset:offset+size]
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._size
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._buffer = b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
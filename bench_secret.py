@@ -0,0 +1,97 @@
+# secret.py 的微基准测试：对比每次调用都重新构造密钥对象（旧实现）
+# 与复用预先构造的密钥对象（当前实现）的单次调用耗时，以及批量签名/验证接口的耗时。
+# 用法：python bench_secret.py [-n 次数] [-s 消息字节数]
+# 使用 --stream 时改为测试流式加解密在不同线程数下的吞吐量：
+# python bench_secret.py --stream [-m 明文MB数] [-c 分块字节数] [-t 1,2,4,8]
+
+
+import argparse
+from io import BytesIO
+from os import urandom
+from time import perf_counter
+from timeit import timeit
+from nacl.public import PrivateKey, SealedBox
+from nacl.signing import SigningKey
+import secret
+
+
+def report(name, seconds, number):
+    print('{:<28}{:>10.1f} us/op'.format(name, seconds / number * 1e6))
+
+
+# 流式加解密的吞吐量与线程数的关系
+
+
+def bench_stream(args):
+    key = secret.new_symmetric_key()
+    plaintext = urandom(args.megabytes * 1024 * 1024)
+    print('{} MB, chunk size {}'.format(args.megabytes, args.chunk_size))
+    print('{:<10}{:>16}{:>16}'.format('threads', 'encrypt MB/s', 'decrypt MB/s'))
+    for threads in [int(t) for t in args.threads.split(',')]:
+        dst = BytesIO()
+        start = perf_counter()
+        secret.symmetric_encrypt_stream(key, BytesIO(plaintext), dst,
+                                        args.chunk_size, threads=threads)
+        encrypt_time = perf_counter() - start
+        dst.seek(0)
+        start = perf_counter()
+        for _ in secret.symmetric_decrypt_stream(key, dst, threads=threads):
+            pass
+        decrypt_time = perf_counter() - start
+        print('{:<10}{:>16.1f}{:>16.1f}'.format(
+            threads, args.megabytes / encrypt_time, args.megabytes / decrypt_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='secret.py microbenchmark')
+    parser.add_argument('-n', '--number', type=int, default=2000)
+    parser.add_argument('-s', '--size', type=int, default=64)
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('-m', '--megabytes', type=int, default=64)
+    parser.add_argument('-c', '--chunk-size', type=int, default=1024*1024)
+    parser.add_argument('-t', '--threads', default='1,2,4,8')
+    args = parser.parse_args()
+    if args.stream:
+        bench_stream(args)
+        return
+    n, message = args.number, b'x' * args.size
+    sk_raw = secret.sk_raw
+
+    # 旧实现：每次调用都由 sk_raw 重新构造密钥对象
+    def old_sign():
+        return SigningKey(sk_raw).sign(message).signature
+
+    def old_verify(signature):
+        return SigningKey(sk_raw).verify_key.verify(message, signature)
+
+    def old_decrypt(ciphertext):
+        return SealedBox(PrivateKey(sk_raw)).decrypt(ciphertext)
+
+    def old_get_pk_raw():
+        return PrivateKey(sk_raw).public_key.encode()
+
+    signature = secret.sign(message)
+    ciphertext = secret.encrypt(message)
+
+    print('before (keys rebuilt on every call)')
+    report('sign', timeit(old_sign, number=n), n)
+    report('verify', timeit(lambda: old_verify(signature), number=n), n)
+    report('decrypt', timeit(lambda: old_decrypt(ciphertext), number=n), n)
+    report('get_pk_raw', timeit(old_get_pk_raw, number=n), n)
+
+    print('after (preconstructed keys)')
+    report('sign', timeit(lambda: secret.sign(message), number=n), n)
+    report('verify', timeit(lambda: secret.verify(message, signature), number=n), n)
+    report('decrypt', timeit(lambda: secret.decrypt(ciphertext), number=n), n)
+    report('get_pk_raw', timeit(secret.get_pk_raw, number=n), n)
+
+    print('batch ({} messages)'.format(n))
+    messages = [message] * n
+    signatures = secret.sign_many(messages)
+    report('sign_many', timeit(lambda: secret.sign_many(messages), number=1), n)
+    report('verify_many', timeit(
+        lambda: secret.verify_many(zip(messages, signatures)), number=1), n)
+
+
+if __name__ == '__main__':
+    main()
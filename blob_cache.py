@@ -0,0 +1,202 @@
+# 共享文件下载的热点密文缓存
+# 热门的共享文件会被反复下载，每次都要查询用户、文件记录并从存储中读取密文与签名。
+# 缓存按 (用户名, 文件名) 记住对应的内容键，按内容键在进程内缓存对外提供的密文与签名，
+# 命中时不访问数据库与存储。缓存按最近最少使用（LRU）淘汰，限制占用的总字节数与单个文件的大小。
+# 准入控制：内容在近期被访问 admit_hits 次后才放入缓存；放入需要淘汰其他条目时，
+# 被淘汰的条目中有近期访问次数比它多的，就不放入，一次性下载的大文件不会挤掉热门的小文件。
+# 访问次数定期减半，过去的热点会逐渐冷却。
+# 文件被删除或取消共享时使 (用户名, 文件名) 的映射失效。配置了 shared_path 时，
+# 同一台主机上的多个 Web 进程通过一块内存映射的共享区域同步失效的代数并汇总命中率等统计信息：
+# 任一进程使映射失效时增加代数，其他进程下次查询时发现代数变化，清空自己的映射。
+# 只有代数在失效时立即写入共享区域；命中率等统计信息先在进程内累计，定期合并写入（见 shared_counters.py）。
+# 密文只能经由映射访问，清空映射后旧的密文不会再被返回，随后按 LRU 淘汰。
+# 映射另有存活时间（TTL），其他主机上的失效最多延迟 ttl 秒生效。
+# 缓存的数据本身仍在各进程内，共享区域只有几十字节。没有 fcntl 的平台（Windows）不支持共享区域。
+
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from shared_counters import open_counters, hit_rate, shared_stats
+
+
+# 记录近期访问次数的内容键个数上限
+SEEN_ENTRIES = 4096
+# 每记录这么多次访问，所有访问次数减半
+AGING_PERIOD = 10000
+# 共享区域中的计数器
+COUNTERS = ('generation', 'hits', 'misses', 'admissions', 'rejections', 'evictions')
+
+
+class BlobCache:
+
+    def __init__(self, max_bytes: int, max_item_bytes: int, admit_hits: int, ttl: float,
+                 shared_path=None):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = min(max_item_bytes, max_bytes)
+        self.admit_hits = admit_hits
+        self.ttl = ttl
+        self.shared = open_counters(shared_path, COUNTERS)
+        # 内容键 -> [签名, 密文, 近期访问次数]，按最近使用的顺序排列
+        self._entries = OrderedDict()
+        # (用户名, 文件名) -> (内容键, 过期时间)
+        self._names = {}
+        # 内容键 -> 近期访问次数，包括尚未放入缓存的内容
+        self._seen = OrderedDict()
+        self._accesses = 0
+        self._generation = 0
+        self._invalidations = 0
+        self._bytes = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.admissions = 0
+        self.rejections = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    # 当前的失效代数。调用者在查询数据库之前取得，放入缓存时传给 put：
+    # 查询期间文件被删除或取消共享时代数已经变化，查询到的旧结果不会放入缓存
+    def generation(self):
+        with self._lock:
+            self._check_generation()
+            return self._generation, self._invalidations
+
+    # 返回 (用户名, 文件名) 对应的 (签名, 密文)，未命中时返回 None
+    def get(self, username: str, filename: str):
+        with self._lock:
+            self._check_generation()
+            key, expires = self._names.get((username, filename), (None, 0))
+            if key is not None and expires <= monotonic():
+                del self._names[(username, filename)]
+                key = None
+            entry = self._entries.get(key) if key is not None else None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self._touch(key)
+                self.hits += 1
+        if entry is None:
+            self._count(misses=1)
+            return None
+        self._count(hits=1)
+        return entry[0], entry[1]
+
+    # 记录一次对内容键 key 的访问（未命中时调用），返回是否已经达到准入所需的访问次数，
+    # 达到时调用者读出密文与签名并调用 put
+    def admit(self, key: str):
+        with self._lock:
+            return self._touch(key) >= self.admit_hits
+
+    # 放入 (用户名, 文件名) 对应的签名与密文，generation 为查询数据库之前取得的失效代数，返回是否放入了缓存
+    def put(self, username: str, filename: str, key: str, signature: bytes, ciphertext: bytes,
+            generation):
+        size = len(signature) + len(ciphertext)
+        evicted = 0
+        with self._lock:
+            self._check_generation()
+            if generation != (self._generation, self._invalidations):
+                return False
+            if key in self._entries:
+                self._names[(username, filename)] = (key, monotonic() + self.ttl)
+                return True
+            frequency = self._seen.get(key, 0)
+            # 找出需要淘汰的最久未使用的条目，其中有比新内容更热门的条目时不放入
+            victims, freed = [], 0
+            if size <= self.max_item_bytes:
+                for victim, entry in self._entries.items():
+                    if self._bytes - freed + size <= self.max_bytes:
+                        break
+                    if entry[2] > frequency:
+                        break
+                    victims.append(victim)
+                    freed += len(entry[0]) + len(entry[1])
+            if size > self.max_item_bytes or self._bytes - freed + size > self.max_bytes:
+                self.rejections += 1
+                admitted = False
+            else:
+                for victim in victims:
+                    self._discard(victim)
+                evicted = len(victims)
+                self.evictions += evicted
+                self._entries[key] = [bytes(signature), bytes(ciphertext), frequency]
+                self._bytes += size
+                self._names[(username, filename)] = (key, monotonic() + self.ttl)
+                self.admissions += 1
+                admitted = True
+        if admitted:
+            self._count(admissions=1, evictions=evicted)
+        else:
+            self._count(rejections=1)
+        return admitted
+
+    # 使 (用户名, 文件名) 的映射失效，并通知其他进程清空各自的映射
+    def invalidate(self, username: str, filename: str):
+        with self._lock:
+            self._names.pop((username, filename), None)
+            self._invalidations += 1
+        if self.shared is not None:
+            self.shared.add(generation=1)
+
+    # 删除内容键 key 的密文与签名，用于密文被删除之后
+    def discard(self, key: str):
+        with self._lock:
+            self._invalidations += 1
+            if key in self._entries:
+                self._discard(key)
+
+    # 返回缓存的统计信息；配置了共享区域时同时返回所有进程汇总的计数，
+    # 其中本进程的计数是最新的，其他进程最近的计数可能还没有写入
+    def stats(self):
+        with self._lock:
+            stats = {'entries': len(self._entries), 'bytes': self._bytes,
+                     'hits': self.hits, 'misses': self.misses,
+                     'hit_rate': hit_rate(self.hits, self.misses),
+                     'admissions': self.admissions, 'rejections': self.rejections,
+                     'evictions': self.evictions}
+        if self.shared is not None:
+            self.shared.flush()
+            stats['shared'] = shared_stats(self.shared)
+        return stats
+
+    # 其他进程增加了代数时清空映射，调用者需持有锁
+    def _check_generation(self):
+        if self.shared is None:
+            return
+        generation = self.shared.get('generation')
+        if generation != self._generation:
+            self._names.clear()
+            self._generation = generation
+
+    # 增加内容键的近期访问次数并返回，定期把所有访问次数减半，调用者需持有锁
+    def _touch(self, key: str):
+        count = self._seen.pop(key, 0) + 1
+        self._seen[key] = count
+        if len(self._seen) > SEEN_ENTRIES:
+            self._seen.popitem(last=False)
+        if key in self._entries:
+            self._entries[key][2] = count
+        self._accesses += 1
+        if self._accesses >= AGING_PERIOD:
+            self._accesses = 0
+            for key_ in self._seen:
+                self._seen[key_] //= 2
+            for entry in self._entries.values():
+                entry[2] //= 2
+        return count
+
+    # 删除条目及指向它的映射，调用者需持有锁
+    def _discard(self, key: str):
+        signature, ciphertext, _ = self._entries.pop(key)
+        self._bytes -= len(signature) + len(ciphertext)
+        for name in [name for name, (key_, _) in self._names.items() if key_ == key]:
+            del self._names[name]
+
+    # 累加共享区域中的统计信息，先在进程内累计，定期合并写入
+    def _count(self, **values):
+        if self.shared is not None:
+            self.shared.count(**values)
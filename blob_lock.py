@@ -0,0 +1,118 @@
+# 按内容键加锁，协调同一内容的并发写入
+# 两个请求同时上传相同的内容时，都会发现密文还不存在而各自加密、写入一份，
+# 后写入的会覆盖先写入的，并且浪费一次加密。持有内容键的锁检查并写入密文、提交记录，
+# 后来的请求等到锁释放后就能看到已经提交的记录，直接复用先完成的密文。
+# 锁按内容键的哈希值分成固定数量的段，每段是一个进程内的锁加上一个锁文件上的 flock，
+# 同一台主机上的多个进程（多个 Web 进程、后台上传的工作进程）之间也能互斥；
+# 不同内容键落在同一段时只是多等待一会儿。没有 fcntl 的平台（Windows）只在进程内互斥。
+# 锁文件只能协调同一台主机上的进程。多台主机共享存储（S3 后端）时使用 DatabaseLock，
+# 每段改为一个 MySQL 命名锁（GET_LOCK），连接同一个数据库的所有主机之间互斥。
+
+
+from contextlib import contextmanager
+from hashlib import blake2b
+from os import path, makedirs
+from threading import Lock
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class StripedLock:
+
+    def __init__(self, lock_dir: str, stripes: int):
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self._locks = [Lock() for _ in range(stripes)]
+
+    # 内容键所在的段
+    def stripe(self, key: str):
+        digest = blake2b(key.encode(), digest_size=4).digest()
+        return int.from_bytes(digest, 'big') % self.stripes
+
+    # 同时持有多个内容键的锁。各段按编号从小到大加锁，多个调用者不会互相死锁；
+    # 多个内容键落在同一段时只加一次锁
+    @contextmanager
+    def hold(self, keys):
+        held = []
+        try:
+            for stripe in sorted(set(self.stripe(key) for key in keys)):
+                self._locks[stripe].acquire()
+                try:
+                    fd = self._lock_file(stripe)
+                except BaseException:
+                    self._locks[stripe].release()
+                    raise
+                held.append((stripe, fd))
+            yield
+        finally:
+            for stripe, fd in reversed(held):
+                if fd is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                    os.close(fd)
+                self._locks[stripe].release()
+
+    # 打开第 stripe 段的锁文件并加排他锁，返回文件描述符
+    def _lock_file(self, stripe: int):
+        if fcntl is None:
+            return None
+        makedirs(self.lock_dir, exist_ok=True)
+        fd = os.open(path.join(self.lock_dir, str(stripe)), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+
+class DatabaseLock(StripedLock):
+    """
+    各段使用 MySQL 命名锁的 StripedLock，锁名为 数据库名.name.段号。
+    命名锁属于数据库连接而不属于事务，持有期间可以提交或回滚会话；每次 hold 单独使用一个连接，
+    一次持有多个段（MySQL 5.7 起支持），连接断开时数据库自动释放其持有的命名锁。
+    同一进程内先取得进程内的锁，同一段的多个线程不会各自占用一个连接等待。
+    """
+
+    def __init__(self, name: str, stripes: int):
+        super().__init__(None, stripes)
+        self.name = name
+
+    @contextmanager
+    def hold(self, keys):
+        from sqlalchemy import text
+        from database import db
+        from config import mysql_schema
+        stripes = sorted(set(self.stripe(key) for key in keys))
+        if not stripes:
+            yield
+            return
+        assert db.engine.dialect.name == 'mysql', 'database blob locks require MySQL'
+        held, named = [], []
+        connection = db.engine.connect()
+        try:
+            for stripe in stripes:
+                self._locks[stripe].acquire()
+                held.append(stripe)
+                name = '{}.{}.{}'.format(mysql_schema, self.name, stripe)
+                # 超时为 -1 时一直等待，与 flock 相同；出错时返回 NULL
+                acquired = connection.execute(
+                    text('SELECT GET_LOCK(:name, -1)'), {'name': name}).scalar()
+                assert acquired == 1, 'failed to acquire database lock ({})'.format(name)
+                named.append(name)
+            yield
+        finally:
+            try:
+                for name in reversed(named):
+                    connection.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': name})
+            except BaseException:
+                # 释放失败时丢弃连接，连接断开后数据库释放其余的命名锁，不会随连接回到连接池
+                connection.invalidate()
+                raise
+            finally:
+                connection.close()
+                for stripe in reversed(held):
+                    self._locks[stripe].release()
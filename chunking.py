@@ -0,0 +1,164 @@
+# 基于内容的分块（Content-Defined Chunking）
+# 使用 Gear 滚动哈希寻找切分点：切分点只取决于附近的内容，
+# 因此在文件中间插入或删除少量字节时，只有附近的块会改变，其余块保持不变，可以跨文件版本去重。
+# 切分规则参考 FastCDC：跳过最小块长度之前的字节，平均块长度前后使用不同难度的掩码，
+# 使块长集中在平均值附近。
+# 安装了 numpy 时一次计算一大段数据中每个位置的哈希再查找切分点，比逐字节计算快得多；
+# 没有 numpy 时逐字节计算，两者切出的块完全相同。
+
+
+from hashlib import blake2b
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Gear 表：256 个固定的 64 位随机数，由字节值的哈希生成，保证每次运行都相同
+GEAR = [int.from_bytes(blake2b(bytes([i]), digest_size=8).digest(), 'big')
+        for i in range(256)]
+MASK64 = (1 << 64) - 1
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64) if numpy is not None else None
+# numpy 每次读取的数据量（最大块长度的倍数）与计算哈希时每段的字节数
+BLOCK_CHUNKS = 4
+GEAR_TILE = 64 * 1024
+
+
+# 取哈希值高位的掩码。Gear 哈希的第 k 位只取决于最近 k+1 个字节，
+# 高位覆盖最近 64 个字节的窗口，所以用高位判断切分点
+
+
+def _high_mask(bits: int):
+    return ((1 << bits) - 1) << (64 - bits)
+
+# 在 buf 中寻找第一个切分点，返回块长度
+# buf 的长度小于 max_size 时，说明已经读到文件末尾
+
+
+def _find_cut(buf, min_size: int, avg_size: int, max_size: int):
+    n = len(buf)
+    if n <= min_size:
+        return n
+    bits = avg_size.bit_length() - 1
+    # 平均块长度之前使用更难满足的掩码，之后使用更容易满足的掩码
+    mask_s, mask_l = _high_mask(bits + 1), _high_mask(bits - 1)
+    gear, h = GEAR, 0
+    # 从最小块长度前 64 个字节开始计算，使 min_size 处的哈希覆盖完整窗口
+    i = max(0, min_size - 64)
+    end_s, end_l = min(avg_size, n), min(max_size, n)
+    while i < end_s:
+        h = ((h << 1) + gear[buf[i]]) & MASK64
+        i += 1
+        if i >= min_size and not h & mask_s:
+            return i
+    while i < end_l:
+        h = ((h << 1) + gear[buf[i]]) & MASK64
+        i += 1
+        if not h & mask_l:
+            return i
+    return end_l
+
+# 从 src 中读取数据并按内容切分，逐块产出，内存占用不超过 max_size 加一次读取的大小
+
+
+def iter_chunks(src, min_size: int, avg_size: int, max_size: int):
+    # 最小块长度不足一个哈希窗口时，切分点处的哈希不一定覆盖完整窗口，只能逐字节计算
+    if numpy is not None and min_size >= 64:
+        yield from _iter_chunks_numpy(src, min_size, avg_size, max_size)
+        return
+    buf = bytearray()
+    eof = False
+    while True:
+        # 缓冲区不足一个最大块时继续读取
+        while not eof and len(buf) < max_size:
+            data = src.read(max_size)
+            if not data:
+                eof = True
+            buf += data
+        if not buf:
+            return
+        cut = _find_cut(buf, min_size, avg_size, max_size)
+        yield bytes(buf[:cut])
+        del buf[:cut]
+
+# 找出 data 中哈希满足掩码的位置，返回 (满足 mask_s 的切分点, 满足 mask_l 的切分点)，
+# 切分点是相对 data 起点的偏移，即满足掩码的字节之后的位置。
+# 以第 k 个字节结尾的 64 字节窗口的哈希为 sum(GEAR[data[k-j]] << j)（j < 64），每一步把窗口长度加倍，共 6 步。
+# 高位全为 0 即哈希小于对应的阈值；mask_l 的位是 mask_s 的一部分，满足 mask_s 的位置是满足 mask_l 的位置的子集。
+# 分段计算，每段的中间结果留在 CPU 缓存中，每段前面多算 63 个字节补足窗口
+
+
+def _gear_cuts(data: bytes, threshold_s, threshold_l):
+    codes = numpy.frombuffer(data, dtype=numpy.uint8)
+    hashes = numpy.empty(GEAR_TILE + 63, dtype=numpy.uint64)
+    shifted = numpy.empty_like(hashes)
+    cuts_s, cuts_l = [], []
+    for start in range(0, len(codes), GEAR_TILE):
+        low = max(0, start - 63)
+        tile = codes[low:start + GEAR_TILE]
+        h = hashes[:len(tile)]
+        numpy.take(GEAR_ARRAY, tile, out=h, mode='clip')
+        width = 1
+        while width < 64:
+            numpy.left_shift(h[:-width], numpy.uint64(width), out=shifted[width:len(tile)])
+            numpy.add(h[width:], shifted[width:len(tile)], out=h[width:])
+            width *= 2
+        h = h[start - low:]
+        found = numpy.flatnonzero(h < threshold_l)
+        cuts_l.append(found + (start + 1))
+        cuts_s.append(found[h[found] < threshold_s] + (start + 1))
+    if not cuts_l:
+        return numpy.empty(0, dtype=numpy.intp), numpy.empty(0, dtype=numpy.intp)
+    return numpy.concatenate(cuts_s), numpy.concatenate(cuts_l)
+
+# 返回有序数组 cuts 中第一个位于 [low, high] 之间的值，没有时返回 None
+
+
+def _first_between(cuts, low: int, high: int):
+    i = int(numpy.searchsorted(cuts, low))
+    if i < len(cuts) and cuts[i] <= high:
+        return int(cuts[i])
+    return None
+
+# 与 iter_chunks 相同，但每次读取 BLOCK_CHUNKS 个最大块长度的数据，一次算出所有位置的哈希与可能的切分点。
+# 缓冲区总是从块的起点开始，min_size >= 64 时每个块中切分点处的哈希窗口都完整地落在缓冲区内，
+# 与逐字节计算的结果相同
+
+
+def _iter_chunks_numpy(src, min_size: int, avg_size: int, max_size: int):
+    bits = avg_size.bit_length() - 1
+    # 高 b 位全为 0 等价于小于 1 << (64 - b)
+    threshold_s = numpy.uint64(1 << (64 - (bits + 1)))
+    threshold_l = numpy.uint64(1 << (64 - (bits - 1)))
+    block = BLOCK_CHUNKS * max_size
+    buf = b''
+    eof = False
+    while True:
+        parts, size = [buf], len(buf)
+        while not eof and size < block:
+            data = src.read(block)
+            if not data:
+                eof = True
+            parts.append(data)
+            size += len(data)
+        buf = b''.join(parts)
+        if not buf:
+            return
+        cuts_s, cuts_l = _gear_cuts(buf, threshold_s, threshold_l)
+        start = 0
+        while start < len(buf):
+            n = len(buf) - start
+            # 剩余数据不足一个最大块时读取更多数据后再切分
+            if not eof and n < max_size:
+                break
+            if n <= min_size:
+                cut = n
+            else:
+                end_s, end_l = min(avg_size, n), min(max_size, n)
+                cut = _first_between(cuts_s, start + min_size, start + end_s)
+                if cut is None:
+                    cut = _first_between(cuts_l, start + end_s + 1, start + end_l)
+                cut = end_l if cut is None else cut - start
+            yield buf[start:start + cut]
+            start += cut
+        buf = buf[start:]
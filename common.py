@@ -1,3 +1,6 @@
+from flask import Request
+
+
 # 用于设置 Cookie的辅助函数
 # token是 Cookie值的令牌(Token)字符串
 def set_token(html: str, token: str):
@@ -24,6 +27,260 @@ def eprint(*args, **kwargs):
     kwargs['file'] = stderr
     return print(*args, **kwargs)
 
+# 把逐块产出字节的迭代器包装成带有 read(size) 方法的只读文件对象，
+# 便于把解密、拼接等生成器直接交给需要文件对象的流式加密函数
+class IterReader:
+    def __init__(self, iterable):
+        self._iter = iter(iterable)
+        self._buf = b''
+
+    def read(self, size=-1):
+        # 缓冲区不足时继续从迭代器中取数据
+        while size < 0 or len(self._buf) < size:
+            chunk = next(self._iter, None)
+            if chunk is None:
+                break
+            self._buf += chunk
+        if size < 0:
+            data, self._buf = self._buf, b''
+        else:
+            data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+
+# 文件中 [offset, offset+length) 区间的只读文件对象，读取与定位都相对于区间的开头，
+# 用于取出单文件容器中的密文部分。创建时就把原文件定位到区间开头：
+# WSGI 服务器用 sendfile 发送文件对象时从文件描述符的当前位置开始，发送的正好是这个区间
+class FileSlice:
+    def __init__(self, file, offset: int, length: int):
+        self._file = file
+        self._offset = offset
+        self.length = length
+        self._pos = 0
+        file.seek(offset)
+
+    def read(self, size=-1):
+        remaining = self.length - self._pos
+        if size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+        data = self._file.read(size)
+        self._pos += len(data)
+        return data
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.length
+        self._pos = min(max(offset, 0), self.length)
+        self._file.seek(self._offset + self._pos)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    # 原文件没有文件描述符时（例如远程存储的对象）抛出 AttributeError，WSGI 服务器会逐块读取发送
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+# 限制写入大小的文件对象：解析 multipart 请求体时，上传文件的内容写入这个对象，
+# 写入的字节数达到 limit 时立即抛出 413，中止解析，不再继续读取、缓存剩余的请求体
+class LimitedFile:
+    def __init__(self, stream, limit: int):
+        self._stream = stream
+        self._limit = limit
+        self._written = 0
+
+    def write(self, data):
+        from werkzeug.exceptions import RequestEntityTooLarge
+        self._written += len(data)
+        if self._written >= self._limit:
+            self._stream.close()
+            raise RequestEntityTooLarge()
+        return self._stream.write(data)
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    # 其余方法（read、seek 等）交给原文件对象
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+# 应用使用的请求类：上传文件的内容超过 max_upload_size 时在解析过程中中止
+# 请求体的总大小由 MAX_CONTENT_LENGTH 限制，声明的 Content-Length 超过限制时不解析直接返回 413
+class UploadRequest(Request):
+    # 普通表单字段在内存中的总大小上限
+    max_form_memory_size = 1024*1024
+    # 请求体大小上限为 max_batch_content_length 的视图（批量上传）
+    batch_endpoints = {'file.post__upload_batch'}
+
+    @property
+    def max_content_length(self):
+        from config import max_batch_content_length
+        if self.endpoint in self.batch_endpoints:
+            return max_batch_content_length
+        return super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        from config import max_upload_size
+        stream = super()._get_file_stream(
+            total_content_length, content_type, filename, content_length)
+        return LimitedFile(stream, max_upload_size)
+
+
+# 构造支持 HTTP Range 的流式下载响应
+# generate(start, length) 返回逐块产出 [start, start+length) 区间字节的迭代器，
+# length 是完整内容的长度，filename 是下载时显示的文件名，etag 是内容的强 ETag（可选）
+def make_range_response(generate, length: int, filename: str, etag=None):
+    from flask import request, Response
+    from werkzeug.datastructures import ContentRange
+    start, stop, status = 0, length, 200
+    # 只处理单个区间的 Range 请求，多区间请求按完整下载处理；
+    # 带有 If-Range 时只有其中的 ETag 与当前内容一致才按区间响应，否则内容已经变化，返回完整内容
+    if_range = request.if_range
+    if_range_ok = (if_range.etag is None and if_range.date is None) or \
+        (etag is not None and if_range.etag == etag)
+    if request.range is not None and len(request.range.ranges) == 1 and if_range_ok:
+        range_ = request.range.range_for_length(length)
+        # 请求的区间无法满足时返回 416
+        if range_ is None:
+            response = Response(status=416)
+            response.content_range = ContentRange('bytes', None, None, length)
+            return response
+        start, stop = range_
+        status = 206
+    response = Response(generate(start, stop - start), status=status,
+                        mimetype='application/octet-stream', direct_passthrough=True)
+    response.content_length = stop - start
+    if status == 206:
+        response.content_range = ContentRange('bytes', start, stop, length)
+    response.accept_ranges = 'bytes'
+    # 设置响应头部，指定下载文件的文件名
+    response.headers['Content-Disposition'] = 'attachment; filename={}'.format(
+        filename)
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+# 构造以文件对象为内容、支持 HTTP Range 的下载响应，file 支持 read、seek 与 tell，length 是内容的长度。
+# 完整下载时响应体是 wsgi.file_wrapper 包装的文件对象，file 有文件描述符时 WSGI 服务器可以用 sendfile 零拷贝发送；
+# Range 请求（以及 If-Range、条件请求）由 werkzeug 处理，定位到区间开头读取，无法满足的区间返回 416
+def make_file_response(file, length: int, filename: str, last_modified=None, etag=None):
+    from flask import request, Response
+    from werkzeug.wsgi import wrap_file
+    response = Response(wrap_file(request.environ, file),
+                        mimetype='application/octet-stream', direct_passthrough=True)
+    response.content_length = length
+    # 设置响应头部，指定下载文件的文件名
+    response.headers['Content-Disposition'] = 'attachment; filename={}'.format(
+        filename)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if etag is not None:
+        response.set_etag(etag)
+    try:
+        return response.make_conditional(request, accept_ranges='bytes', complete_length=length)
+    except Exception:
+        # 区间无法满足时响应体不会被发送，关闭文件
+        file.close()
+        raise
+
+# 由内容派生的强 ETag：kind 区分同一份内容的不同表示（密文、签名等），data 是能唯一确定内容的字节串
+# （签名、哈希值、公钥等），内容不变时 ETag 不变
+def content_etag(kind: str, data: bytes):
+    from hashlib import blake2b
+    return blake2b(kind.encode() + b'\x00' + data, digest_size=16).hexdigest()
+
+
+# 设置内容不变的下载响应的 ETag 与 Cache-Control，有效期为 max_age 秒，为 0 时每次使用前都要重新验证。
+# public 为真时反向代理等共享缓存也可以保存（公开的内容）；
+# 否则只允许浏览器保存，并按 Cookie 区分，同一浏览器中登录的其他用户不会用到
+def set_cache_headers(response, etag: str, max_age: int, public=False):
+    response.set_etag(etag)
+    if public:
+        response.cache_control.public = True
+    else:
+        response.cache_control.private = True
+        response.vary.add('Cookie')
+    response.cache_control.max_age = max_age
+    if max_age == 0:
+        response.cache_control.no_cache = True
+    return response
+
+
+# 请求的 If-None-Match 与 etag 匹配时返回带有同样缓存头部的 304 响应，否则返回 None。
+# 在读取内容之前调用，客户端或反向代理重新验证时不需要读取、发送内容
+def not_modified(etag: str, max_age: int, public=False):
+    from flask import request, Response
+    if request.method in ('GET', 'HEAD') and request.if_none_match.contains_weak(etag):
+        return set_cache_headers(Response(status=304), etag, max_age, public)
+    return None
+
+
+# 只追加写入的缓冲区，供 zipfile 写入。没有 seek 方法，zipfile 会按不可定位的流处理，
+# 在每个文件的数据之后写入数据描述符，不需要回头修改已经写出的部分
+class _ZipBuffer:
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    # 取出已经写入的数据
+    def take(self):
+        data, self._chunks = b''.join(self._chunks), []
+        return data
+
+
+# 边生成边产出 ZIP 压缩包。members 中每一项为 (压缩包中的文件名, 逐块产出内容的迭代器, 是否压缩)，
+# 内容逐块写入压缩包并立即产出，内存占用只与单个块的大小有关
+def iter_zip(members):
+    import zipfile
+    from time import localtime
+    buffer = _ZipBuffer()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, content, compress in members:
+            info = zipfile.ZipInfo(name, date_time=localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+            # 打开条目时还不知道内容的大小，不强制使用 ZIP64 时超过 2GiB 的条目会在写完后才报错，
+            # 此时已经产出了不完整的压缩包
+            with archive.open(info, 'w', force_zip64=True) as dst:
+                for block in content:
+                    dst.write(block)
+                    data = buffer.take()
+                    if data:
+                        yield data
+            yield buffer.take()
+    # 中央目录
+    yield buffer.take()
+
+
 # 这是一个装饰器函数 login_required，它用于要求用户在访问某些页面或执行某些操作之前必须登录。
 
 
@@ -44,15 +301,18 @@ def login_required(func):
         # 使用 OnlineUser.verify_token(token)来验证该令牌的有效性。
         record = OnlineUser.verify_token(token)
         if record:
-            # 如果验证通过（令牌有效），则使用 OnlineUser.create_record 创建一个新的 Token，
-            # 并将用户的ID存储在数据库中。这可能是用于更新用户会话状态的逻辑。
-            token = OnlineUser.create_record(record.id_)
+            # 如果验证通过（令牌有效），则使用 OnlineUser.renew_record 按滑动续期策略续期，
+            # 只有令牌使用了足够长的时间才会创建新的 Token 并写入数据库，否则沿用原令牌。
+            new_token = OnlineUser.renew_record(record)
             # 如果存在"user"参数，我们从数据库中查询User模型获取对应的用户对象，
             # 并将其作为关键字参数传递给装饰的函数。
             if 'user' in func.__code__.co_varnames:
                 kwargs['user'] = User.get_by(id_=record.id_)
                 # 若 Token验证通过，调用装饰的函数 func(*args, **kwargs)，将得到的结果作为响应。
-            return set_token(func(*args, **kwargs), token)
+            # 令牌更换时才需要重新设置 Cookie
+            if new_token != token:
+                return set_token(func(*args, **kwargs), new_token)
+            return func(*args, **kwargs)
         else:
             # 如果用户的 Token验证未通过，我们使用 redirect('/login')将用户重定向到登录页面。
             return redirect('/login')
@@ -18,12 +18,106 @@ csrf_key = os.urandom(24)
 # models/online_user
 
 token_expired = 30*60
+# 令牌滑动续期的比例：令牌签发后经过 token_expired 的这一比例的时间后，下一次请求才更换令牌，
+# 在此之前的请求不写数据库。会话在最后一次续期后 token_expired 秒内没有请求即失效
+token_renew_ratio = 0.5
+# 会话模式：'db' 令牌存储在 online_users 表中，每次验证都查询数据库；
+# 'stateless' 令牌由服务器密钥加密认证，验证时不查询数据库，多个 Web 节点无需共享会话表
+session_mode = 'db'
+# stateless 模式下各进程从数据库刷新已登出令牌集合的间隔（秒），其他节点上的登出最多延迟这么久生效
+revocation_refresh = 10
 
+# 存储后端：'local' 把密文保存在本地目录 storage_path 中；
+# 's3' 保存在 S3 兼容的对象存储（AWS S3、MinIO 等）中，需要安装 boto3，多个 Web 节点共享同一个存储桶即可水平扩展；
+# 此时内容键锁使用 MySQL 的命名锁（GET_LOCK，需要 MySQL 5.7 以上），各节点需连接同一个数据库
+storage_backend = 'local'
 storage_path = './storage/'
+# 存储目录的分目录布局：取哈希值的前几位作为各级子目录名，例如 [2, 2] 时文件存储在 ab/cd/<哈希值>，
+# 避免单个目录中的文件过多。空列表为扁平布局；修改后用 python manage.py migrate-layout 迁移已有的文件
+storage_fanout = []
+# 写入密文的持久化策略：'none' 不主动刷盘；'file' 在临时文件改名发布前执行 fsync；
+# 'full' 还在改名后对所在目录执行 fsync，保证掉电后改名本身也不会丢失
+storage_fsync = 'file'
+# 内容键锁的分段数：同一内容的并发上传只有第一个执行加密写入，其余等待并复用其结果。
+# 本地存储的锁是 storage_path 下锁文件上的 flock，只在同一台主机上互斥；S3 存储使用数据库的命名锁
+blob_lock_stripes = 256
+# S3 后端的设置：存储桶、对象键前缀、服务地址（使用 AWS S3 时为 None）与访问密钥，
+# 连接池的连接数上限、分段上传的分段大小（不小于 5MB），以及读取时每次区间请求的大小
+s3_bucket = 'ac-imf'
+s3_prefix = ''
+s3_endpoint_url = None
+s3_access_key = None
+s3_secret_key = None
+s3_region = None
+s3_max_connections = 32
+s3_part_size = 8*1024*1024
+s3_read_size = 1024*1024
 nacl_sk_path = './nacl_sk'
+# 服务器公钥（/public_key）响应的缓存有效期（秒），更换服务器密钥后客户端最多在这段时间内使用旧的公钥
+public_key_cache_max_age = 24*60*60
+# 用户对称密钥缓存：最多缓存的用户数、密钥占用的字节数上限，以及每个条目的存活时间（秒），
+# 条目数设为 0 时不缓存。同一台主机上各 Web 进程的命中率等统计信息汇总在内存映射文件 key_cache_shared_path 中，
+# 设为空时不汇总
+key_cache_entries = 1024
+key_cache_bytes = 64*1024
+key_cache_ttl = 10*60
+key_cache_shared_path = './storage/key_cache'
 
 # models/file
 # config.py
 
 allowed_file_suffix_list = ['doc', 'docx', 'xls', 'xlsx',
                             'ppt', 'pptx', 'pdf', 'png', 'jpg', 'jpeg', 'gif']
+
+# 上传文件大小上限（字节）
+max_upload_size = 10*1024*1024
+# 请求体大小上限（字节），在上传文件大小上限的基础上留出 multipart 编码与其他表单字段的空间
+max_content_length = max_upload_size + 64*1024
+# 批量上传：一次请求最多包含的文件数、请求体大小上限（字节），以及并行计算哈希、加密的线程数
+max_batch_files = 256
+max_batch_content_length = 200*1024*1024
+upload_threads = 4
+# 上传模式：'sync' 在请求中完成哈希、加密、签名与存储；
+# 'background' 请求只把上传内容加密暂存（只有服务器用户可以读取），由本地进程池在后台完成其余步骤，文件列表中显示处理状态
+upload_mode = 'sync'
+# 后台上传的工作进程数，0 表示与 CPU 核心数相同
+upload_workers = 0
+# 流式加解密的分块大小（字节），决定单次上传/下载的内存占用
+stream_chunk_size = 64*1024
+# 流式加解密使用的线程数，大于 1 时多个密文块在线程池中并行加密、解密，
+# 内存占用为线程数乘以分块大小。可以用 python bench_secret.py --stream 比较不同线程数的吞吐量
+crypto_threads = 1
+# 加密前压缩明文的 zlib 压缩级别（1-9），0 表示不压缩。
+# 列表中的文件类型本身已经压缩过，不再压缩；其他文件先试压第一块，压缩效果不明显时也会跳过
+compress_level = 0
+compress_skip_suffix_list = ['png', 'jpg', 'jpeg', 'gif', 'docx', 'xlsx', 'pptx']
+# 密文存储模式：
+# 'per_user' 每个用户用自己的对称密钥加密并单独存储密文；
+# 'convergent' 用由内容派生的文件密钥加密，相同内容全局只存储、签名一份；
+# 'chunked' 在 convergent 的基础上按内容分块，每个块全局只存储一份，相近版本的文件只存储变化的部分
+storage_mode = 'per_user'
+# chunked 模式的最小、平均、最大块长度（字节），平均块长度须为 2 的幂
+cdc_min_size = 16*1024
+cdc_avg_size = 64*1024
+cdc_max_size = 256*1024
+# 秒传预检查签发的上传凭证有效期（秒）
+upload_ticket_expired = 30*60
+# 断点续传的分块大小（字节），须小于 max_content_length
+upload_chunk_size = 1024*1024
+# 断点续传会话的有效期（秒），过期的会话及其暂存的块在创建新会话时清除
+upload_session_expired = 24*60*60
+# 签名、密文与哈希值下载响应的缓存有效期（秒）。响应带有由内容派生的 ETag，过期后重新验证只需一个 304 响应；
+# 删除后重新上传同名文件时，客户端最多在这段时间内使用旧的内容
+download_cache_max_age = 24*60*60
+# 共享文件下载响应的缓存有效期（秒），反向代理也可以缓存。共享的文件随时可能被删除或取消共享，
+# 默认为 0，每次使用前都要向服务器重新验证（内容未变时只返回 304）；设为正数时，删除或取消共享最多延迟这么久生效
+shared_download_cache_max_age = 0
+# 共享文件下载的热点密文缓存（见 blob_cache.py）：每个进程缓存占用的字节数上限（0 表示不缓存）、
+# 单个文件的大小上限、放入缓存所需的近期访问次数，以及 (用户名, 文件名) 映射的存活时间（秒）。
+# 同一台主机上的 Web 进程通过内存映射文件 blob_cache_shared_path 同步失效，
+# 多台主机之间不同步，删除或取消共享的文件最多还能在其他主机上下载 blob_cache_ttl 秒
+blob_cache_bytes = 256*1024*1024
+blob_cache_item_bytes = 16*1024*1024
+blob_cache_admit_hits = 2
+blob_cache_ttl = 60
+blob_cache_shared_path = './storage/blob_cache'
@@ -36,6 +36,16 @@ def create_app(name):
     """
     app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
 
+    """
+    限制请求体的大小。请求声明的 Content-Length 超过 MAX_CONTENT_LENGTH 时，
+    在解析请求体之前直接返回 413；UploadRequest 在解析 multipart 请求体的过程中
+    检查上传文件的大小，超过 max_upload_size 时立即中止，不会把超大的请求体先缓存下来。
+    """
+    from config import max_content_length
+    from common import UploadRequest
+    app.config['MAX_CONTENT_LENGTH'] = max_content_length
+    app.request_class = UploadRequest
+
     # 使用 db.init_app(app)初始化数据库连接，将 db对象和 Flask应用关联起来。
     db.init_app(app)
 
@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, FileField
-from wtforms.validators import DataRequired
+from wtforms import StringField, PasswordField, FileField, HiddenField, IntegerField, MultipleFileField
+from wtforms.validators import DataRequired, InputRequired, NumberRange
 
 # 用于处理密码输入
 
@@ -49,3 +49,30 @@ class FileForm(FlaskForm):
     # FileField表示它用于处理文件上传类型的数据
     # 字段的标签（即描述信息）被设置为"file"
     file = FileField('file', validators=[FileRequired()])
+    # 秒传预检查返回的上传凭证，由页面脚本填写，可以为空
+    ticket = HiddenField('ticket')
+
+# PrecheckForm 表单类用于文件秒传的预检查，客户端只提交文件的哈希值、文件名和大小。
+
+
+class PrecheckForm(FlaskForm):
+    hash_value = StringField('hash_value', validators=[DataRequired()])
+    filename = StringField('filename', validators=[DataRequired()])
+    # 大小可以为 0，因此使用 InputRequired 而不是 DataRequired
+    size = IntegerField('size', validators=[
+                        InputRequired(), NumberRange(min=0)])
+
+# UploadSessionForm 表单类用于创建断点续传的上传会话，ticket 为秒传预检查返回的上传凭证，可以为空。
+
+
+class UploadSessionForm(FlaskForm):
+    filename = StringField('filename', validators=[DataRequired()])
+    size = IntegerField('size', validators=[
+                        InputRequired(), NumberRange(min=0)])
+    ticket = HiddenField('ticket')
+
+# BatchUploadForm 表单类用于批量上传，files 字段可以包含多个文件。
+
+
+class BatchUploadForm(FlaskForm):
+    files = MultipleFileField('files')
@@ -0,0 +1,103 @@
+# 用户对称密钥的进程内缓存
+# 用户的对称密钥用服务器公钥以 SealedBox 加密存储，每次上传、下载都要做一次 Curve25519 解密，
+# 而密钥本身不会改变，因此在进程内缓存解密结果。
+# 缓存按最近最少使用（LRU）淘汰，同时限制条目数、密钥占用的字节数和每个条目的存活时间（TTL）。
+# 条目以加密后的密钥作为校验值，用户更换密钥后旧条目不再命中，自动失效。
+# 密钥以普通的 bytes 对象返回给调用者并交给 PyNaCl 使用，Python 无法可靠地清除其内存中的副本，
+# 缓存只通过条目数上限与 TTL 限制明文密钥在进程内停留的时间，不清零内存。
+# 配置了 shared_path 时，同一台主机上各进程的命中、未命中与淘汰次数汇总在共享区域中
+# （见 shared_counters.py），可通过 manage.py key-cache-stats 查看。
+
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from shared_counters import open_counters, hit_rate, shared_stats
+
+# 共享区域中的计数器
+COUNTERS = ('hits', 'misses', 'evictions')
+
+
+class KeyCache:
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float, shared_path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.shared = open_counters(shared_path, COUNTERS)
+        # 用户ID -> (加密后的密钥, 密钥, 过期时间)，按最近使用的顺序排列
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # 返回用户 id_ 的密钥：命中时直接返回，否则调用 unwrap(wrapped) 解密并放入缓存
+    def get(self, id_, wrapped: bytes, unwrap):
+        now = monotonic()
+        with self._lock:
+            entry = self._entries.get(id_)
+            if entry is not None and entry[0] == wrapped and entry[2] > now:
+                self._entries.move_to_end(id_)
+                self.hits += 1
+                key = entry[1]
+            else:
+                key = None
+                self.misses += 1
+                # 已过期或密钥已更换的条目立即清除
+                if entry is not None:
+                    self._discard(id_)
+        if key is not None:
+            self._count(hits=1)
+            return key
+        self._count(misses=1)
+
+        # 解密不持有锁，避免阻塞其他用户的请求
+        key = unwrap(wrapped)
+        if self.max_entries <= 0 or len(key) > self.max_bytes:
+            return key
+
+        evicted = 0
+        with self._lock:
+            if id_ in self._entries:
+                self._discard(id_)
+            self._entries[id_] = (bytes(wrapped), bytes(key), now + self.ttl)
+            self._bytes += len(key)
+            # 超出条目数或字节数预算时，淘汰最久未使用的条目
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+                evicted += 1
+            self.evictions += evicted
+        if evicted:
+            self._count(evictions=evicted)
+        return key
+
+    # 使用户 id_ 的条目失效，id_ 为 None 时清空整个缓存
+    def invalidate(self, id_=None):
+        with self._lock:
+            for key in list(self._entries) if id_ is None else [id_]:
+                if key in self._entries:
+                    self._discard(key)
+
+    # 返回缓存的统计信息；配置了共享区域时同时返回所有进程汇总的计数
+    def stats(self):
+        with self._lock:
+            stats = {'entries': len(self._entries), 'bytes': self._bytes,
+                     'hits': self.hits, 'misses': self.misses,
+                     'hit_rate': hit_rate(self.hits, self.misses),
+                     'evictions': self.evictions}
+        if self.shared is not None:
+            self.shared.flush()
+            stats['shared'] = shared_stats(self.shared)
+        return stats
+
+    # 删除条目，调用者需持有锁
+    def _discard(self, id_):
+        _, key, _ = self._entries.pop(id_)
+        self._bytes -= len(key)
+
+    # 累加共享区域中的统计信息，先在进程内累计，定期合并写入
+    def _count(self, **values):
+        if self.shared is not None:
+            self.shared.count(**values)
@@ -0,0 +1,396 @@
+"""
+manage.py 是运维用的命令行工具，在应用上下文中执行数据库与存储相关的维护任务。
+用法：python manage.py <命令> [参数]，使用 python manage.py -h 查看所有命令。
+
+upgrade-schema 命令为已有的数据表补上新版本增加的列（新增的列都允许为空）和索引。
+
+rebuild-blobs 命令根据 files 表重新统计 blobs 表中每份密文的引用计数，
+用于为升级前已有的文件补齐 blobs 记录，或修复不一致的引用计数。
+
+migrate-convergent 命令把按用户加密存储的密文转换为 convergent 模式的全局密文，
+相同内容只保留一份。
+
+verify-signatures 命令逐个检查存储中的密文与签名文件是否匹配，新旧两种签名格式都可以检查。
+
+resume-uploads 命令在当前进程中完成 Web 进程重启前没有处理完的后台上传，
+找不到暂存数据的文件标记为上传失败。
+
+migrate-layout 命令把密文迁移到 config 中 storage_fanout 指定的分目录布局，
+迁移期间服务不需要停止：每份密文提交新位置之前一直读取旧位置，旧位置的对象过了宽限期（--grace 秒）才删除。
+"""
+
+
+import argparse
+from os import remove
+
+
+# 为已有的数据表补上模型中新增的列
+def upgrade_schema(args):
+    from sqlalchemy import inspect
+    from sqlalchemy.schema import CreateColumn
+    from database import db
+
+    # 先创建缺少的表
+    db.create_all()
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = set(column['name']
+                       for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            # 新增的列都允许为空，可以直接添加到已有的表中
+            ddl = 'ALTER TABLE {} ADD COLUMN {}'.format(
+                table.name, CreateColumn(column).compile(dialect=db.engine.dialect))
+            print(ddl)
+            db.session.execute(ddl)
+    db.session.commit()
+
+    # 创建缺少的索引
+    for table in db.metadata.sorted_tables:
+        existing = set(index['name']
+                       for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                print('CREATE INDEX {}'.format(index.name))
+                index.create(db.engine)
+
+
+# 根据 files 表重建 blobs 表
+def rebuild_blobs(args):
+    from database import db
+    from models import File, Blob
+    from backends import get_backend
+    import secret
+
+    # 统计每份密文被文件记录引用的次数
+    expected = {}
+    for f in File.query.filter(File.status.is_(None)).all():
+        expected[f.blob_key] = expected.get(f.blob_key, 0) + 1
+
+    # chunked 模式的每个 manifest 对其中的每个块各引用一次，
+    # manifest 用由内容派生的文件密钥加密，服务器可以直接解密
+    manifests = db.session.query(File.hash_value).filter(
+        File.layout == 'chunked', File.status.is_(None)).distinct().all()
+    for hash_value, in manifests:
+        for chunk_hash, _ in Blob.read_manifest(Blob.manifest_key(hash_value),
+                                                secret.convergent_key(hash_value)):
+            key = Blob.chunk_key(chunk_hash)
+            expected[key] = expected.get(key, 0) + 1
+
+    # 修正已有记录，删除已经没有引用的记录
+    for blob in Blob.query.all():
+        count = expected.pop(blob.key, 0)
+        if count:
+            blob.refcount = count
+        else:
+            print('unreferenced blob: {}'.format(blob.key))
+            db.session.delete(blob)
+
+    # 为缺少记录的密文补齐记录，密文可能还在旧的扁平布局中
+    backend = get_backend()
+    for key, count in expected.items():
+        location = Blob.probe(key)
+        if not backend.exists(location):
+            print('missing blob: {}'.format(key))
+            continue
+        db.session.add(Blob(key=key, refcount=count, location=location,
+                            size=backend.size(location)))
+
+    db.session.commit()
+    print('{} blobs'.format(Blob.query.count()))
+
+
+# 把 per_user 模式的密文转换为 convergent 模式的全局密文
+def migrate_convergent(args):
+    from hashlib import sha512
+    from database import db
+    from models import File, Blob, User
+    from common import IterReader
+    import secret
+
+    files = File.query.filter(File.wrapped_key.is_(None), File.status.is_(None)).all()
+    for f in files:
+        user = User.get_by(id_=f.creator_id)
+        symmetric_key = user.get_symmetric_key()
+        old_key, new_key = f.blob_key, Blob.global_key(f.hash_value)
+        file_key = secret.convergent_key(f.hash_value)
+
+        # 持有新旧密文内容键的锁，与同时上传、删除相同内容的请求互斥
+        with Blob.lock([new_key, old_key]):
+            # 全局密文不存在时，逐块解密旧密文并用文件密钥重新加密，同时校验内容的哈希值
+            if not Blob.committed(new_key):
+                hash_obj = sha512()
+
+                def plaintext(src):
+                    for chunk in secret.symmetric_decrypt_stream(symmetric_key, src):
+                        hash_obj.update(chunk)
+                        yield chunk
+
+                with Blob.open_ciphertext(Blob.locate(old_key)) as src:
+                    size = Blob.write(new_key, file_key, IterReader(plaintext(src)))
+                if hash_obj.hexdigest() != f.hash_value:
+                    print('hash mismatch, skipped: {}/{}'.format(f.creator_id, f.filename))
+                    Blob.discard([Blob.location_for(new_key)])
+                    continue
+            else:
+                size = None
+
+            # 在同一个事务中切换文件记录引用的密文，并调整两份密文的引用计数
+            f.wrapped_key = secret.wrap_key(symmetric_key, file_key)
+            Blob.acquire(new_key, Blob.location_for(new_key), size)
+            old_location = Blob.release(old_key)
+            db.session.commit()
+            Blob.discard([old_location])
+        print('migrated: {}/{}'.format(f.creator_id, f.filename))
+
+
+# 检查每份对外提供的密文与其签名文件是否匹配
+def verify_signatures(args):
+    from models import Blob
+    from common import IterReader
+    import secret
+
+    # 逐块读取多个对象中的密文部分
+    def read_parts(parts):
+        for location in parts:
+            with Blob.open_ciphertext(location) as f:
+                yield from iter(lambda: f.read(1024*1024), b'')
+
+    bad = 0
+    for blob in Blob.query.all():
+        # 块存储中的块没有单独的签名，由引用它们的 manifest 的签名覆盖
+        if blob.key.startswith('k/'):
+            continue
+        location = blob.location
+        signature = Blob.read_signature(location)
+        if signature is None:
+            print('missing signature: {}'.format(blob.key))
+            bad += 1
+            continue
+
+        # chunked 模式对外提供的密文为 manifest 密文与各块密文的拼接
+        parts = [location]
+        if blob.key.startswith('m/'):
+            entries = Blob.read_manifest(
+                blob.key, secret.convergent_key(blob.key[len('m/'):]))
+            parts += Blob.locate_many([Blob.chunk_key(chunk_hash) for chunk_hash, _ in entries])
+        if not secret.verify_stream(IterReader(read_parts(parts)), signature):
+            print('bad signature: {}'.format(blob.key))
+            bad += 1
+    print('{} bad signatures'.format(bad))
+
+
+# 完成没有处理完的后台上传
+def resume_uploads(args):
+    from os import path
+    from database import db
+    from models import File, User
+    from upload_worker import spool_path_for, SpoolReader
+
+    for f in File.query.filter(File.status == 'pending').all():
+        # 按文件记录中的任务编号找回暂存的数据
+        spool_path = spool_path_for(f.creator_id, f.job) if f.job else None
+        if spool_path is None or not path.exists(spool_path):
+            print('no spooled data, marked failed: {}/{}'.format(f.creator_id, f.filename))
+            f.status = 'failed'
+            db.session.commit()
+            continue
+
+        creator_id, filename, job = f.creator_id, f.filename, f.job
+        reader = SpoolReader(spool_path, filename, User.get_by(id_=creator_id).get_symmetric_key())
+        try:
+            File.complete_pending(creator_id, filename, job, reader)
+            print('completed: {}/{}'.format(creator_id, filename))
+        except Exception as e:
+            print('failed: {}/{} ({!r})'.format(creator_id, filename, e))
+        finally:
+            reader.close()
+        remove(spool_path)
+
+
+# 把密文与签名迁移到当前配置的存储布局
+def migrate_layout(args):
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    from time import monotonic, sleep
+    from flask import current_app
+    from database import db
+    from models import Blob
+    from backends import get_backend
+
+    backend = get_backend()
+    # 工作线程查询数据库时需要应用上下文
+    app = current_app._get_current_object()
+
+    # 逐个迁移内容键，持有内容键的锁，与同时写入、删除同一内容的请求互斥。
+    # 锁定记录后先把对象复制到新位置（本地存储使用硬链接），旧格式单独存储的签名在密文之前，
+    # 再提交新的位置，提交之后才释放锁。返回 (内容键, 旧位置)；记录已被删除或已经迁移时旧位置为 None，
+    # 找不到对象时为 False
+    def migrate(key):
+        with app.app_context(), Blob.lock([key]):
+            blob = Blob.query.filter_by(key=key).with_for_update().first()
+            new = Blob.location_for(key)
+            if blob is None or blob.location == new:
+                db.session.rollback()
+                return key, None
+            old = blob.location
+            for suffix in ('.sig', ''):
+                if backend.exists(old + suffix) and not backend.exists(new + suffix):
+                    backend.copy(old + suffix, new + suffix)
+            if not backend.exists(new):
+                db.session.rollback()
+                return key, False
+            blob.location = new
+            db.session.commit()
+            return key, old
+
+    todo = [blob.key for blob in Blob.query.all()
+            if blob.location != Blob.location_for(blob.key)]
+    print('{} blobs to migrate'.format(len(todo)))
+    # 提交新位置之前开始的下载可能仍在读取旧位置的对象，旧位置的对象过了宽限期才删除
+    moved, missing, expired = 0, 0, deque()
+    with ThreadPoolExecutor(args.threads) as pool:
+        for key, old in pool.map(migrate, todo):
+            if old is False:
+                print('missing blob: {}'.format(key))
+                missing += 1
+            elif old is not None:
+                expired.append((monotonic() + args.grace, old))
+                moved += 1
+                if moved % 1000 == 0:
+                    print('{}/{} blobs migrated'.format(moved, len(todo)))
+            while expired and expired[0][0] <= monotonic():
+                Blob.discard([expired.popleft()[1]])
+    print('{} blobs migrated, {} missing'.format(moved, missing))
+    if expired:
+        print('deleting old copies in {} seconds'.format(round(expired[-1][0] - monotonic())))
+    for deadline, old in expired:
+        sleep(max(0, deadline - monotonic()))
+        Blob.discard([old])
+
+
+# 把签名单独存储（.sig）的旧格式密文转换为签名与密文在同一个对象中的单文件容器
+def pack_signatures(args):
+    from concurrent.futures import ThreadPoolExecutor
+    from flask import current_app
+    from models import Blob
+    from backends import get_backend
+
+    backend = get_backend()
+    # 工作线程查询数据库时需要应用上下文
+    app = current_app._get_current_object()
+
+    # 持有内容键的锁，与同时写入同一内容的上传互斥。容器原子地替换旧的密文之后再删除单独的签名，
+    # 读取者任何时候都能找到签名；上次转换中断、只剩下签名没有删除时直接删除
+    def pack(key):
+        with app.app_context(), Blob.lock([key]):
+            location = Blob.locate(key)
+            if not backend.exists(location + '.sig'):
+                return False
+            with backend.open(location) as f:
+                _, signature = Blob.read_container(f)
+            if signature is None:
+                with backend.open(location + '.sig') as f:
+                    signature = f.read()
+                with backend.writer(location) as dst:
+                    dst.write(Blob.pack_container(signature))
+                    for block in backend.iter_range(location, 0, backend.size(location)):
+                        dst.write(block)
+            backend.delete(location + '.sig')
+            # 转换期间被删除的密文，删除刚写入的容器
+            if not Blob.committed(key):
+                Blob.discard([location])
+            return True
+
+    # 块存储中的块没有单独的签名
+    keys = [blob.key for blob in Blob.query.all() if not blob.key.startswith('k/')]
+    print('{} blobs to check'.format(len(keys)))
+    with ThreadPoolExecutor(args.threads) as pool:
+        packed = sum(pool.map(pack, keys))
+    print('{} blobs packed'.format(packed))
+
+
+# 显示共享文件下载缓存在本机所有 Web 进程中汇总的命中率等统计信息
+def blob_cache_stats(args):
+    from config import blob_cache_shared_path
+    from blob_cache import COUNTERS
+    print_shared_stats('blob_cache_shared_path', blob_cache_shared_path, COUNTERS)
+
+
+# 显示用户对称密钥缓存在本机所有 Web 进程中汇总的命中率等统计信息
+def key_cache_stats(args):
+    from config import key_cache_shared_path
+    from key_cache import COUNTERS
+    print_shared_stats('key_cache_shared_path', key_cache_shared_path, COUNTERS)
+
+
+# 打印 path_ 处共享计数器的值，setting 为配置该路径的设置名
+def print_shared_stats(setting, path_, fields):
+    from shared_counters import open_counters, shared_stats
+
+    shared = open_counters(path_, fields)
+    if shared is None:
+        print('{} is not configured'.format(setting))
+        return
+    for name, value in shared_stats(shared).items():
+        print('{}: {}'.format(name, round(value, 4) if isinstance(value, float) else value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ac-IMF maintenance commands')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser(
+        'upgrade-schema', help='add columns and indexes introduced by newer versions to existing tables')
+    command.set_defaults(func=upgrade_schema)
+
+    command = commands.add_parser(
+        'rebuild-blobs', help='rebuild blob reference counts from the files table')
+    command.set_defaults(func=rebuild_blobs)
+
+    command = commands.add_parser(
+        'migrate-convergent', help='convert per-user blobs to convergent-encrypted global blobs')
+    command.set_defaults(func=migrate_convergent)
+
+    command = commands.add_parser(
+        'verify-signatures', help='check every stored ciphertext against its signature file')
+    command.set_defaults(func=verify_signatures)
+
+    command = commands.add_parser(
+        'resume-uploads', help='finish background uploads left pending by a restart')
+    command.set_defaults(func=resume_uploads)
+
+    command = commands.add_parser(
+        'migrate-layout', help='move stored ciphertexts into the configured sharded directory layout')
+    command.add_argument('--threads', type=int, default=4,
+                         help='number of files moved in parallel')
+    command.add_argument('--grace', type=float, default=600,
+                         help='seconds to keep old copies for downloads that already resolved them')
+    command.set_defaults(func=migrate_layout)
+
+    command = commands.add_parser(
+        'pack-signatures', help='merge separately stored signature files into single-file blob containers')
+    command.add_argument('--threads', type=int, default=4,
+                         help='number of blobs converted in parallel')
+    command.set_defaults(func=pack_signatures)
+
+    command = commands.add_parser(
+        'blob-cache-stats', help='show hit rate and counters of the shared-file download cache')
+    command.set_defaults(func=blob_cache_stats)
+
+    command = commands.add_parser(
+        'key-cache-stats', help='show hit rate and counters of the user symmetric key cache')
+    command.set_defaults(func=key_cache_stats)
+
+    args = parser.parse_args()
+
+    # 在应用上下文中执行命令
+    from database import create_app
+    app = create_app(__name__)
+    with app.app_context():
+        args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 """
-文件中使用相对路径导入了 User、OnlineUser 和 File 这三个模块
+文件中使用相对路径导入了 User、OnlineUser、File、Blob、RevokedToken 和 UploadSession 这六个模块
 例如，当其他文件导入了 models 包时，可以直接通过 
 from models import User 的方式使用 User 类，而不需要从具体的 user.py 文件导入
 """
@@ -7,3 +7,6 @@ from models import User 的方式使用 User 类，而不需要从具体的 user
 from .user import User
 from .online_user import OnlineUser
 from .file import File
+from .blob import Blob
+from .revoked_token import RevokedToken
+from .upload_session import UploadSession
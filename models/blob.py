@@ -0,0 +1,373 @@
+"""
+此文件定义了 Blob 类，用于记录存储中的每一份密文（blob）及其引用计数。
+多条文件记录可以引用同一份密文，只有最后一个引用被删除时才会删除磁盘上的密文与签名。
+
+函数 location_for(key)，按配置的分目录布局计算内容键的存储位置
+
+函数 locate(cls, key)、locate_many(cls, keys)，返回内容键对应的对象记录在 blobs 表中的存储位置，不访问存储
+
+函数 probe(key)，检查存储，返回没有记录的内容键对应的对象所在的位置，同时兼容迁移前的扁平布局
+
+函数 discard(locations)，删除存储中的对象及其签名
+
+函数 pack_container(signature)、read_container(f)，写入、解析单文件容器的头部与签名
+
+函数 open_ciphertext(location)，打开存储中的对象，返回只包含对外提供的密文部分的只读文件对象
+
+函数 read_signature(location)，读取存储中的对象的签名，兼容签名单独存储的旧格式
+
+函数 lock(keys)，持有内容键的锁，协调同一内容的并发写入与删除；S3 存储使用数据库的命名锁，多台主机之间也能互斥
+
+函数 committed(cls, key)，用单独的连接查询内容键是否已有提交的记录
+
+函数 get(cls, key)，根据内容键查询 blob 记录
+
+函数 acquire(cls, key, location, size)，增加引用计数，记录不存在时新建
+
+函数 release(cls, key)，减少引用计数，计数归零时删除记录并返回需要删除的存储位置
+
+函数 write(key, symmetric_key, src, sign, compress_level)，把明文流式加密（可选先压缩）写入存储，
+sign 为真时签名与密文写入同一个容器对象
+
+函数 scan_chunks(src)，把明文按内容分块，返回 (块哈希, 明文长度) 列表，用于写入前确定需要加锁的块
+
+函数 write_chunked(key, file_key, src, entries, compress_level)，按 scan_chunks 的结果把明文的每块单独加密存入块存储，
+并把块列表（manifest）加密存储在 key 对应的位置
+
+函数 read_manifest(key, file_key)，读取并解密 manifest，返回 (块哈希, 明文长度) 列表
+
+函数 release_manifest(cls, key, file_key, entries)，减少 manifest 的引用计数，
+归零时同时减少其中每个块的引用计数，返回需要删除的存储位置列表
+
+引用计数的修改都不提交数据库会话，由调用者与文件记录的修改放在同一个事务中提交。
+存储的读写都通过 backends.get_backend() 返回的存储后端进行。
+"""
+
+
+import struct
+from contextlib import contextmanager
+from sqlalchemy import Column, String, Integer, BigInteger
+from database import db
+from backends import get_backend
+from blob_lock import StripedLock, DatabaseLock
+from config import storage_path, storage_backend, blob_lock_stripes
+import secret
+
+# 内容键的锁。本地存储的锁文件保存在 storage_path 下的 locks 目录中；
+# S3 存储由多台主机共享，锁文件不能在主机之间互斥，改用数据库的命名锁。
+# 块存储中的块单独使用一组锁：写入、删除文件时先持有文件密文（manifest）的锁，再持有其中各块的锁
+if storage_backend == 's3':
+    blob_locks = DatabaseLock('blob', blob_lock_stripes)
+    chunk_locks = DatabaseLock('chunk', blob_lock_stripes)
+else:
+    blob_locks = StripedLock(storage_path + 'locks/', blob_lock_stripes)
+    chunk_locks = StripedLock(storage_path + 'locks/k/', blob_lock_stripes)
+
+# locate_many 每次查询的内容键个数上限
+LOCATE_BATCH = 500
+
+# 单文件容器：签名与密文存储在同一个对象中，一次打开即可得到两者，不再需要单独的 .sig 对象。
+# 容器头部为 魔数(8) 版本(1) 标志(1，保留) 签名长度(2)，之后是签名文件的内容（版本化的签名），
+# 再之后是对外提供的密文，密文自身的头部记录了分块大小、nonce 前缀与明文大小。
+# 没有容器头部的对象是旧格式的裸密文，签名存储在该位置加上 .sig 的对象中，
+# 由 manage.py pack-signatures 转换；块存储中的块没有签名，仍为裸密文
+CONTAINER_MAGIC = b'CUCBLOB\x00'
+CONTAINER_VERSION = 1
+CONTAINER_HEADER = struct.Struct('>8sBBH')
+# 写入的签名文件的长度，密文写完之前先写入同样长度的占位内容
+CONTAINER_SIGNATURE_SIZE = secret.SIG_HEADER.size + secret.SIGNATURE_SIZE
+
+
+class Blob(db.Model):
+    """
+    定义表 blobs
+    字段有:内容键（主键，带索引）、引用计数、密文大小和存储后端中的存储位置。
+    存储位置由 location_for 根据内容键计算，迁移布局时由 manage.py migrate-layout 更新。
+    """
+    __tablename__ = 'blobs'
+    key = Column(String(160), primary_key=True)
+    refcount = Column(Integer, nullable=False, default=0)
+    size = Column(BigInteger)
+    location = Column(String(255), nullable=False)
+
+    # 按 config 中的 storage_fanout 计算内容键的存储位置：
+    # 取内容键最后一段（哈希值）的前几位作为多级子目录，避免单个目录中的文件过多，
+    # 例如 storage_fanout 为 [2, 2] 时，'c/abcdef...' 存储在 'c/ab/cd/abcdef...'。
+    # storage_fanout 为空时存储位置与内容键相同，即旧的扁平布局
+    @staticmethod
+    def location_for(key):
+        from config import storage_fanout
+        prefix, _, name = key.rpartition('/')
+        parts, offset = [prefix], 0
+        for width in storage_fanout:
+            parts.append(name[offset:offset+width])
+            offset += width
+        parts.append(name)
+        return '/'.join(parts)
+
+    # 内容键对应的对象当前的存储位置，即 blobs 表中记录的位置，只查询数据库，不访问存储。
+    # manage.py migrate-layout 先把对象复制到新位置、提交新的位置之后才删除旧位置的对象。
+    # 没有记录的内容键（还没有提交的写入）返回按当前布局计算的位置
+    @classmethod
+    def locate(cls, key):
+        return cls.locate_many([key])[0]
+
+    # 与 locate 相同，一次查询多个内容键（例如 manifest 中的所有块），按 keys 的顺序返回存储位置列表
+    @classmethod
+    def locate_many(cls, keys):
+        unique = list(set(keys))
+        locations = {}
+        for start in range(0, len(unique), LOCATE_BATCH):
+            locations.update(db.session.query(cls.key, cls.location).filter(
+                cls.key.in_(unique[start:start+LOCATE_BATCH])).all())
+        return [locations.get(key) or cls.location_for(key) for key in keys]
+
+    # 检查存储，返回内容键对应的对象所在的位置，用于 manage.py rebuild-blobs 为没有记录的对象补齐记录：
+    # 对象可能还在旧的扁平布局中，先检查新位置，再检查旧位置；都不存在时返回新位置。
+    # 扁平布局下新旧位置相同，不需要访问存储
+    @staticmethod
+    def probe(key):
+        new = Blob.location_for(key)
+        if new == key:
+            return new
+        backend = get_backend()
+        if not backend.exists(new) and backend.exists(key):
+            return key
+        return new
+
+    # 删除存储中的对象及其签名（旧格式单独存储的 .sig），用于引用计数归零后的清理，以及写入、提交失败时的回滚
+    @staticmethod
+    def discard(locations):
+        backend = get_backend()
+        for location in locations:
+            if location:
+                backend.delete(location)
+                backend.delete(location + '.sig')
+
+    # 容器头部与签名
+    @staticmethod
+    def pack_container(signature: bytes):
+        return CONTAINER_HEADER.pack(CONTAINER_MAGIC, CONTAINER_VERSION, 0, len(signature)) + signature
+
+    # 从文件对象 f 的开头读取容器头部，返回 (密文的起始偏移, 签名)；旧格式的裸密文返回 (0, None)
+    @staticmethod
+    def read_container(f):
+        head = f.read(CONTAINER_HEADER.size)
+        if len(head) == CONTAINER_HEADER.size:
+            magic, version, _, signature_size = CONTAINER_HEADER.unpack(head)
+            if magic == CONTAINER_MAGIC:
+                assert version == CONTAINER_VERSION, 'unsupported blob container version'
+                return CONTAINER_HEADER.size + signature_size, f.read(signature_size)
+        return 0, None
+
+    # 打开 location 处的对象，返回只包含对外提供的密文部分的只读文件对象（common.FileSlice），
+    # 读取与定位都相对于密文的开头，可以直接交给流式解密函数或作为下载的响应体
+    @staticmethod
+    def open_ciphertext(location):
+        from common import FileSlice
+        f = get_backend().open(location)
+        try:
+            offset, _ = Blob.read_container(f)
+            size = f.seek(0, 2)
+        except BaseException:
+            f.close()
+            raise
+        return FileSlice(f, offset, size - offset)
+
+    # 读取 location 处密文的签名文件内容：容器中的签名，旧格式读取单独存储的 .sig；没有签名时返回 None
+    @staticmethod
+    def read_signature(location):
+        backend = get_backend()
+        with backend.open(location) as f:
+            _, signature = Blob.read_container(f)
+        if signature is None and backend.exists(location + '.sig'):
+            with backend.open(location + '.sig') as f:
+                signature = f.read()
+        return signature
+
+    # 持有内容键的锁。写入密文的调用者从检查密文是否存在一直持有到提交 blob 记录，
+    # 同一内容的其他写入者等待锁释放后，通过 committed 就能看到已提交的记录，直接复用；
+    # 删除密文的调用者从减少引用计数一直持有到删除存储中的对象。
+    # 块的内容键（chunk_key）使用另一组锁，在其他内容键之后加锁。为了不互相死锁，
+    # 每组锁都要在一次调用中全部取得：可以先持有其他内容键的锁再调用一次持有块的锁，反过来则不行
+    @staticmethod
+    @contextmanager
+    def lock(keys):
+        keys = list(keys)
+        chunks = [key for key in keys if key.startswith('k/')]
+        with blob_locks.hold([key for key in keys if not key.startswith('k/')]), \
+                chunk_locks.hold(chunks):
+            yield
+
+    # 内容键是否已有提交的记录。使用单独的连接查询，不受当前会话的事务快照影响：
+    # MySQL 默认的可重复读隔离级别下，事务开始后其他连接提交的记录在本事务中不可见
+    @classmethod
+    def committed(cls, key):
+        with db.engine.connect() as conn:
+            return conn.execute(cls.__table__.select().where(cls.key == key)).first() is not None
+
+    # 按用户划分的密文内容键，与存储位置一致
+    @staticmethod
+    def user_key(user_id, hash_value):
+        return '{}/{}'.format(user_id, hash_value)
+
+    # convergent 模式下所有用户共享的密文内容键
+    @staticmethod
+    def global_key(hash_value):
+        return 'c/{}'.format(hash_value)
+
+    # chunked 模式下文件的块列表（manifest）的内容键
+    @staticmethod
+    def manifest_key(hash_value):
+        return 'm/{}'.format(hash_value)
+
+    # chunked 模式下块存储中每个块的内容键
+    @staticmethod
+    def chunk_key(chunk_hash):
+        return 'k/{}'.format(chunk_hash)
+
+    # 从 src 中分块读取明文，用 symmetric_key 流式加密后写入 key 对应的存储位置，
+    # sign 为真时把签名与密文写入同一个容器，compress_level 不为 0 时先压缩明文，返回写入的对象大小。
+    # 先写入占位的容器头部，密文写完后回到开头回填签名，整个对象原子地发布，签名与密文总是一致的。
+    # 写入失败时对象没有发布，该位置上已有的对象（可能是其他写入者发布的）保持不变，不需要删除
+    @staticmethod
+    def write(key, symmetric_key, src, sign=True, compress_level=0):
+        from config import stream_chunk_size
+        backend = get_backend()
+        location = Blob.location_for(key)
+        # 边加密边计算密文的签名摘要，不需要把密文读回内存
+        signer = secret.StreamSigner() if sign else None
+        with backend.writer(location) as f:
+            if sign:
+                f.write(Blob.pack_container(bytes(CONTAINER_SIGNATURE_SIZE)))
+            secret.symmetric_encrypt_stream(
+                symmetric_key, src, f, stream_chunk_size, signer,
+                compress_level=compress_level)
+            size = f.tell()
+            if sign:
+                f.seek(0)
+                f.write(Blob.pack_container(signer.finish()))
+                f.seek(size)
+        return size
+
+    # 把 src 中的明文按内容分块，返回 (块哈希, 明文长度) 列表。
+    # 写入前先得到所有块的内容键，调用者一次持有它们的锁，再调用 write_chunked
+    @staticmethod
+    def scan_chunks(src):
+        from hashlib import sha512
+        from chunking import iter_chunks
+        from config import cdc_min_size, cdc_avg_size, cdc_max_size
+        return [(sha512(chunk).hexdigest(), len(chunk))
+                for chunk in iter_chunks(src, cdc_min_size, cdc_avg_size, cdc_max_size)]
+
+    # 按 scan_chunks 得到的 entries 从 src 中依次读出各块存入块存储，并把 manifest 用 file_key 加密存储在 key 对应的位置。
+    # 调用者需持有所有块的锁，直到提交引用计数：块存储中已有记录的块直接增加引用计数，不再重复加密，
+    # 因此相近版本的文件只需加密、存储变化的部分；没有记录的块由本次写入，存储中残留的同名对象
+    # （写入者在提交前崩溃）会被覆盖。持有锁时其他上传不会写入或删除这些块。
+    # 对外提供的密文为 manifest 密文与各块密文按顺序的拼接，签名覆盖这一拼接结果，与 manifest 密文存储在同一个容器中。
+    # 返回 (manifest 对象大小, 本次新写入的存储位置列表)。引用计数的修改由调用者提交；
+    # 失败时删除本次新写入的对象，会话中已经增加的引用计数由调用者回滚
+    @classmethod
+    def write_chunked(cls, key, file_key, src, entries, compress_level=0):
+        from hashlib import sha512
+        from io import BytesIO
+        from config import stream_chunk_size
+        written = []
+        try:
+            for chunk_hash, length in entries:
+                chunk = src.read(length)
+                assert sha512(chunk).hexdigest() == chunk_hash, 'content changed during upload'
+                chunk_key = cls.chunk_key(chunk_hash)
+                size = None
+                # 本次会话中已经增加过引用计数的块（同一文件或同一批中重复的块）也有记录
+                if cls.get(chunk_key) is None and not cls.committed(chunk_key):
+                    size = cls.write(chunk_key, secret.convergent_key(chunk_hash), BytesIO(chunk),
+                                     sign=False, compress_level=compress_level)
+                    written.append(cls.location_for(chunk_key))
+                cls.acquire(chunk_key, cls.location_for(chunk_key), size)
+            manifest = ''.join('{} {}\n'.format(chunk_hash, size)
+                               for chunk_hash, size in entries).encode()
+            # manifest 很小，先在内存中加密，再按顺序逐块读取各块，计算对外提供的密文的签名
+            ciphertext = BytesIO()
+            secret.symmetric_encrypt_stream(file_key, BytesIO(manifest), ciphertext, stream_chunk_size)
+            ciphertext = ciphertext.getvalue()
+            signer = secret.StreamSigner()
+            signer.update(ciphertext)
+            for location in cls.locate_many([cls.chunk_key(chunk_hash) for chunk_hash, _ in entries]):
+                with cls.open_ciphertext(location) as f:
+                    for data in iter(lambda: f.read(stream_chunk_size), b''):
+                        signer.update(data)
+            data = cls.pack_container(signer.finish()) + ciphertext
+            get_backend().put(cls.location_for(key), data)
+            written.append(cls.location_for(key))
+            size = len(data)
+        except Exception:
+            # 删除本次新写入的块与 manifest
+            cls.discard(written)
+            raise
+        return size, written
+
+    # 读取并解密 key 对应的 manifest，返回 (块哈希, 明文长度) 列表
+    @staticmethod
+    def read_manifest(key, file_key):
+        with Blob.open_ciphertext(Blob.locate(key)) as f:
+            manifest = secret.symmetric_decrypt(file_key, f.read()).decode()
+        entries = []
+        for line in manifest.splitlines():
+            chunk_hash, size = line.split()
+            entries.append((chunk_hash, int(size)))
+        return entries
+
+    @classmethod
+    def get(cls, key):
+        # 主键查询，只需一次索引查找
+        return cls.query.filter_by(key=key).first()
+
+    @classmethod
+    def acquire(cls, key, location, size):
+        # 锁定该行，避免并发上传时引用计数丢失
+        blob = cls.query.filter_by(key=key).with_for_update().first()
+
+        # 记录不存在，说明是新写入的密文，新建记录
+        if blob is None:
+            blob = Blob(key=key, refcount=0, size=size, location=location)
+            db.session.add(blob)
+
+        # 增加引用计数
+        blob.refcount += 1
+        return blob
+
+    @classmethod
+    def release(cls, key):
+        # 锁定该行，避免并发删除时引用计数丢失
+        blob = cls.query.filter_by(key=key).with_for_update().first()
+
+        # 没有记录时不删除任何文件，宁可遗留密文也不误删
+        if blob is None:
+            return None
+
+        # 减少引用计数，归零时删除记录，并返回需要删除的存储位置
+        blob.refcount -= 1
+        if blob.refcount > 0:
+            return None
+        location = blob.location
+        db.session.delete(blob)
+        return location
+
+    @classmethod
+    def release_manifest(cls, key, file_key, entries=None):
+        # manifest 仍被引用时，不影响其中的块
+        manifest_location = cls.release(key)
+        if manifest_location is None:
+            return []
+
+        # manifest 不再被引用，释放其中的每个块（manifest 中重复出现的块会被释放多次，与写入时一致）。
+        # 调用者已经读出 manifest（为了持有其中各块的锁）时通过 entries 传入，不再重复读取
+        locations = [manifest_location]
+        if entries is None:
+            entries = cls.read_manifest(key, file_key)
+        for chunk_hash, _ in entries:
+            chunk_location = cls.release(cls.chunk_key(chunk_hash))
+            if chunk_location:
+                locations.append(chunk_location)
+        return locations
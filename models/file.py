@@ -1,23 +1,47 @@
 """
 此文件定义了 File 类, 包含:
 表 files 的定义
+上传前校验方法 check_upload
+秒传预检查方法 precheck
 上传文件方法 upload_file
+批量上传文件方法 upload_files
+创建文件记录方法 add_record
+还原文件密钥方法 content_key
 删除文件方法 delete_file
 下载文件方法 download_file
+下载共享文件方法 download_shared
+打包导出方法 export_files
 分享文件方法 share_file
 """
 
 
-from sqlalchemy import Column, String, Integer, Boolean, ForeignKey, and_
-from os import remove, path, mkdir
+from sqlalchemy import Column, String, Integer, Boolean, LargeBinary, ForeignKey, and_
+from contextlib import contextmanager
+from os import remove
 import re
 from database import db
-from config import storage_path
+from config import storage_mode
+from config import blob_cache_bytes, blob_cache_item_bytes, blob_cache_admit_hits, blob_cache_ttl, \
+    blob_cache_shared_path
+from backends import get_backend
+from blob_cache import BlobCache
+from .blob import Blob
+from common import eprint
 import secret
 
+# 共享文件下载的热点密文缓存，统计信息可通过 blob_cache.stats() 或 manage.py blob-cache-stats 查看
+blob_cache = BlobCache(blob_cache_bytes, blob_cache_item_bytes, blob_cache_admit_hits,
+                       blob_cache_ttl, blob_cache_shared_path)
+
 # 使用正则表达式检查文件名中是否包含非中文字符
 filename_pattern = re.compile(r'[^\u4e00-\u9fa5]+')
 
+# SHA-512 哈希值的十六进制形式
+hash_pattern = re.compile(r'[0-9a-f]{128}')
+
+# 上传凭证使用的派生密钥用途
+TICKET_PERSON = b'upload-ticket'
+
 
 class File(db.Model):
     """
@@ -32,18 +56,31 @@ class File(db.Model):
     filename = Column(String(64), primary_key=True)
     hash_value = Column(String(128))
     shared = Column(Boolean, default=False)
+    # convergent 与 chunked 模式下用创建者的对称密钥包装后的文件密钥，per_user 模式下为空
+    wrapped_key = Column(LargeBinary(72))
+    # chunked 模式的文件为 'chunked'，引用的是块列表（manifest），其他模式为空
+    layout = Column(String(16))
+    # 后台上传的处理状态：'pending' 正在后台处理，'failed' 处理失败，为空表示已就绪
+    status = Column(String(16))
+    # 后台上传的任务编号，处理完成后清空
+    job = Column(String(32))
+
+    # 该文件所引用的密文在 blobs 表中的内容键
+    @property
+    def blob_key(self):
+        if self.layout == 'chunked':
+            return Blob.manifest_key(self.hash_value)
+        if self.wrapped_key is not None:
+            return Blob.global_key(self.hash_value)
+        return Blob.user_key(self.creator_id, self.hash_value)
 
     """
-    定义了类方法 upload_file，用于上传文件。该方法首先对文件名进行校验，然后检查文件类型是否合法。
-    接着，读取文件内容，对其进行大小限制，然后计算文件内容的哈希值。
-    如果文件不存在，将对文件内容进行加密，并将加密后的内容和签名保存到指定的存储路径。
-    最后，将文件信息添加到数据库中。
+    定义了类方法 check_upload，用于上传前的校验。首先对文件名进行校验，然后检查文件类型是否合法，
+    最后确认该用户没有同名文件。
     """
     @classmethod
-    def upload_file(cls, user, data):
-        from hashlib import sha512
+    def check_upload(cls, user, filename):
         from config import allowed_file_suffix_list
-        filename = data.filename
 
         # 校验文件名长度不超过64个字符
         assert len(filename) <= 64, 'filename too long (>64B)'
@@ -65,47 +102,394 @@ class File(db.Model):
         # 断言文件不存在，避免重复上传同名文件
         assert not f, 'file already exists'
 
-        # 读取上传的内容,并检查是否小于10MB
-        content = data.read()
-        assert len(content) < 10*1024*1024, 'file too large (>=10MB)'
-
-        # 构建用户的文件存储路径
-        user_id = str(user.id_)+'/'
-
-        # 如果用户的存储路径不存在，则创建目录
-        if not path.exists(storage_path+user_id):
-            if not path.exists(storage_path):
-                mkdir(storage_path)
-            mkdir(storage_path+user_id)
-
-        # 计算原文件的哈希
-        hash_value = sha512(content).hexdigest()
-
-        # 判断文件是否存在
-        if not path.exists(storage_path+user_id+hash_value):
-            # 加密并存储。加密前得先还原出对称密钥。
-            content = secret.symmetric_encrypt(
-                secret.decrypt(user.encrypted_symmetric_key), content)
-            # 同时计算签名
-            signature = secret.sign(content)
-            # 保存密文与签名
-            with open(storage_path+user_id+hash_value, 'wb') as f:
-                f.write(content)
-            with open(storage_path+user_id+hash_value+'.sig', 'wb') as f:
-                f.write(signature)
-
-        # 用户ID作为文件的创建者ID
-        creator_id = user.id_
-
-        # 创建文件记录，并将其添加到数据库中
-        file = File(creator_id=creator_id,
-                    filename=filename, hash_value=hash_value)
-        db.session.add(file)
-        db.session.commit()
+    """
+    定义了类方法 precheck，用于文件秒传的预检查。客户端先提交文件的哈希值、文件名和大小，
+    如果该用户已有相同内容的文件，则直接创建文件记录，无需再传输文件内容，返回 None；
+    否则返回一个上传凭证（ticket），客户端随后上传文件时附上该凭证，
+    服务器会校验上传的内容与预检查时声明的哈希值和大小一致。
+    """
+    @classmethod
+    def precheck(cls, user, filename, hash_value, size):
+        import json
+        from time import time
+        from config import max_upload_size, upload_ticket_expired
+
+        cls.check_upload(user, filename)
+
+        # 校验声明的大小与哈希值格式
+        assert 0 <= size < max_upload_size, 'file too large (>={}B)'.format(
+            max_upload_size)
+        assert hash_pattern.fullmatch(hash_value), 'invalid hash value'
+
+        # 该用户已有相同内容的文件时，核对明文大小后直接引用同一份密文创建文件记录。
+        # 只复用用户自己已经拥有的内容：仅凭哈希值不能证明客户端持有文件，
+        # 不能据此引用其他用户上传的密文
+        def owned():
+            return File.query.filter(
+                and_(File.creator_id == user.id_, File.hash_value == hash_value)).first()
+
+        f = owned()
+        if f is not None:
+            key = f.blob_key
+            # 持有内容键的锁，与同时删除该用户最后一个相同内容文件的请求互斥：
+            # 加锁后重新查询，密文的记录已经提交时才引用，否则与没有相同内容的文件一样签发凭证
+            with Blob.lock([key]):
+                f = owned()
+                if f is not None and f.blob_key == key and Blob.committed(key):
+                    plain_size = f.plaintext_size(user)
+                    assert plain_size is None or plain_size == size, 'size mismatch'
+                    cls.add_record(user, filename, hash_value,
+                                   key, None, f.wrapped_key, f.layout)
+                    return None
+
+        # 否则签发上传凭证，凭证中记录用户、文件名、哈希值、大小与过期时间
+        payload = dict(user=user.id_, filename=filename, hash_value=hash_value,
+                       size=size, expires=int(time()) + upload_ticket_expired)
+        return secret.seal_token(TICKET_PERSON, json.dumps(payload).encode())
+
+    """
+    定义了类方法 upload_file，用于上传文件。该方法首先通过 check_upload 校验文件名与文件类型。
+    接着，分块读取文件内容，对其进行大小限制，同时计算文件内容的哈希值。
+    如果附带了预检查得到的上传凭证（或已经校验过的凭证内容 claim），则校验内容与凭证中声明的哈希值和大小一致。
+    如果相同内容的密文不存在，将文件内容分块流式加密，并将加密后的内容和签名保存到指定的存储路径。
+    最后，将文件信息添加到数据库中。
+    """
+    @classmethod
+    def upload_file(cls, user, data, ticket=None, claim=None):
+        from config import upload_mode
+        filename = data.filename
+
+        cls.check_upload(user, filename)
+
+        # 解析上传凭证，凭证必须属于当前用户、当前文件且未过期；
+        # claim 为调用者已经校验过的凭证内容（断点续传会话在创建时校验），不再检查有效期
+        if ticket:
+            claim = cls.open_ticket(user, filename, ticket)
+
+        # 后台上传模式下只暂存内容，由后台进程完成其余步骤
+        if upload_mode == 'background':
+            return cls.enqueue_upload(user, data, claim)
+
+        # 创建文件记录并增加密文的引用计数，两者在同一个事务中提交
+        with cls.store_upload(user, data, claim) as stored:
+            cls.add_record(user, filename, *stored)
+
+    """
+    定义了类方法 store_upload，计算上传内容的哈希并校验上传凭证，相同内容的密文不存在时加密写入存储，
+    得到 (哈希值, 内容键, 密文大小, 包装后的文件密钥, 存储布局, 本次新写入的存储位置列表)，
+    正好是 add_record 除用户和文件名以外的参数。
+    用作上下文管理器：with 块中持有内容键的锁，调用者在 with 块中提交记录，
+    同时上传相同内容的其他请求等待提交后直接复用这份密文，不会重复加密或覆盖。
+    chunked 模式先分块得到所有块的内容键，再同时持有它们的锁，直到提交块的引用计数。
+    写入失败时回滚会话中已经增加的引用计数。
+    """
+    @classmethod
+    @contextmanager
+    def store_upload(cls, user, data, ticket=None):
+        filename = data.filename
+        hash_value, size = cls.hash_upload(data)
+
+        # 校验上传的内容与预检查时声明的一致
+        if ticket:
+            assert ticket['hash_value'] == hash_value and ticket['size'] == size, \
+                'content does not match ticket'
+
+        key, file_key, wrapped_key, layout = cls.storage_target(user, hash_value)
+
+        with Blob.lock([key]):
+            # 通过 blobs 表判断相同内容的密文是否已经存在
+            blob_size, cleanup, chunks = None, [], None
+            committed = Blob.committed(key)
+            if not committed and layout == 'chunked':
+                data.seek(0)
+                chunks = Blob.scan_chunks(data)
+            with Blob.lock([Blob.chunk_key(chunk_hash) for chunk_hash, _ in chunks or ()]):
+                if not committed:
+                    # 分块加密并写入存储路径。加密前得先还原出对称密钥。
+                    try:
+                        blob_size, cleanup = cls.write_blob(
+                            key, file_key or user.get_symmetric_key(), layout, data, filename, chunks)
+                    except Exception:
+                        db.session.rollback()
+                        raise
+                yield hash_value, key, blob_size, wrapped_key, layout, cleanup
+
+    """
+    定义了类方法 enqueue_upload，后台上传模式下把上传内容用用户的对称密钥加密暂存，创建状态为 pending 的文件记录并记下任务编号，
+    再把哈希、加密、签名与存储交给后台进程池。
+    """
+    @classmethod
+    def enqueue_upload(cls, user, data, ticket=None):
+        from upload_worker import new_job, spool_upload, submit_upload
+        job = new_job()
+        spool_path = spool_upload(user.id_, job, data, user.get_symmetric_key())
+        try:
+            db.session.add(File(creator_id=user.id_, filename=data.filename, status='pending', job=job))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            remove(spool_path)
+            raise
+        submit_upload(user.id_, data.filename, job, ticket)
+
+    """
+    定义了类方法 complete_pending，由后台进程调用，完成任务 job 对应的状态为 pending 的文件的上传：
+    存储内容后在同一个事务中填写文件记录并增加密文的引用计数。
+    处理失败时把文件标记为 failed；处理期间文件已被删除（包括删除后又上传了同名文件）时，丢弃本次写入的密文。
+    """
+    @classmethod
+    def complete_pending(cls, user_id, filename, job, data, ticket=None):
+        from .user import User
+        user = User.get_by(id_=user_id)
+        try:
+            with cls.store_upload(user, data, ticket) as (hash_value, key, size, wrapped_key,
+                                                          layout, cleanup):
+                try:
+                    f = File.query.filter(
+                        and_(File.creator_id == user_id, File.filename == filename,
+                             File.job == job)).with_for_update().first()
+                    assert f is not None and f.status == 'pending', 'file removed during upload'
+                    f.hash_value, f.wrapped_key, f.layout, f.status, f.job = \
+                        hash_value, wrapped_key, layout, None, None
+                    Blob.acquire(key, Blob.location_for(key), size)
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    Blob.discard(cleanup)
+                    raise
+        except Exception:
+            # 文件仍在等待本任务处理时标记为失败；已被删除时什么也不做
+            db.session.rollback()
+            f = File.query.filter(
+                and_(File.creator_id == user_id, File.filename == filename, File.job == job)).first()
+            if f is not None and f.status == 'pending':
+                f.status = 'failed'
+                db.session.commit()
+            raise
+
+    """
+    定义了类方法 upload_files，用于批量上传文件，返回每个文件的 (文件名, 错误信息)，成功时错误信息为 None。
+    各文件的哈希计算与加密在线程池中并行进行，所有文件记录在同一个事务中提交。
+    单个文件校验或写入失败只影响该文件（chunked 模式每个文件在单独的保存点中写入，失败时只回滚该文件的块引用计数）；
+    提交失败时所有文件都上传失败。
+    写入与提交期间持有本批所有内容键的锁，chunked 模式还持有本批所有块的锁。
+    """
+    @classmethod
+    def upload_files(cls, user, files):
+        from concurrent.futures import ThreadPoolExecutor
+        from contextlib import ExitStack
+        from config import upload_threads
+
+        def message(e):
+            return e.args[0] if len(e.args) else str(e)
+
+        # 先在当前线程中校验文件名，同一批中也不允许同名文件
+        errors, names, pending = {}, set(), []
+        for i, data in enumerate(files):
+            try:
+                cls.check_upload(user, data.filename)
+                assert data.filename not in names, 'file already exists'
+                names.add(data.filename)
+                pending.append(i)
+            except AssertionError as e:
+                errors[i] = message(e)
+
+        # 本批持有的内容键的锁，提交或回滚之后才释放
+        targets, sizes, cleanup, locks = {}, {}, [], ExitStack()
+        try:
+            with ThreadPoolExecutor(upload_threads) as pool:
+                # 并行计算各文件的哈希值
+                futures = [(i, pool.submit(cls.hash_upload, files[i])) for i in pending]
+                hashes = {}
+                for i, future in futures:
+                    try:
+                        hashes[i] = future.result()[0]
+                    except AssertionError as e:
+                        errors[i] = message(e)
+
+                for i, hash_value in hashes.items():
+                    targets[i] = (hash_value,) + cls.storage_target(user, hash_value)
+                locks.enter_context(Blob.lock([target[1] for target in targets.values()]))
+
+                # 在当前线程中查询数据库，确定需要写入的密文，同一批中相同内容的密文只写入一次；
+                # 再把写入交给线程池并行加密。chunked 模式写入时要修改块的引用计数，只能在当前线程中进行：
+                # 先在线程池中并行分块，再一次持有所有块的锁，逐个写入
+                writes, scans = {}, {}
+                for i, (hash_value, key, file_key, wrapped_key, layout) in targets.items():
+                    if key in writes or key in scans or Blob.committed(key):
+                        continue
+                    file_key = file_key or user.get_symmetric_key()
+                    if layout == 'chunked':
+                        files[i].seek(0)
+                        scans[key] = (i, file_key, pool.submit(Blob.scan_chunks, files[i]))
+                    else:
+                        writes[key] = pool.submit(
+                            cls.write_blob, key, file_key, layout, files[i], files[i].filename)
+
+                chunks = {key: future.result() for key, (_, _, future) in scans.items()}
+                locks.enter_context(Blob.lock([Blob.chunk_key(chunk_hash) for entries in chunks.values()
+                                               for chunk_hash, _ in entries]))
+                # 每个文件的写入放在一个保存点中，写入失败时只撤销该文件增加的块引用计数
+                failed = set()
+                for key, (i, file_key, _) in scans.items():
+                    savepoint = db.session.begin_nested()
+                    try:
+                        sizes[key], written = cls.write_blob(
+                            key, file_key, 'chunked', files[i], files[i].filename, chunks[key])
+                        savepoint.commit()
+                        cleanup += written
+                    except Exception as e:
+                        savepoint.rollback()
+                        failed.add(key)
+                        eprint('failed to store blob {}: {!r}'.format(key, e))
+
+                for key, future in writes.items():
+                    try:
+                        sizes[key], written = future.result()
+                        cleanup += written
+                    except Exception as e:
+                        failed.add(key)
+                        eprint('failed to store blob {}: {!r}'.format(key, e))
+
+            # 创建所有文件记录并增加密文的引用计数，在同一个事务中提交
+            for i, (hash_value, key, _, wrapped_key, layout) in targets.items():
+                if key in failed:
+                    errors[i] = 'failed to store file'
+                    continue
+                db.session.add(File(creator_id=user.id_, filename=files[i].filename,
+                                    hash_value=hash_value, wrapped_key=wrapped_key, layout=layout))
+                Blob.acquire(key, Blob.location_for(key), sizes.get(key))
+            db.session.commit()
+        except Exception:
+            # 回滚所有记录，删除本次新写入的密文
+            db.session.rollback()
+            Blob.discard(cleanup)
+            raise
+        finally:
+            locks.close()
+
+        return [(data.filename, errors.get(i)) for i, data in enumerate(files)]
+
+    """
+    定义了静态方法 hash_upload，分块读取上传的内容，计算原文件的哈希，并检查大小是否超过限制，
+    返回 (哈希值, 大小)。不再一次性读入整个文件，内存占用只与分块大小有关。
+    """
+    @staticmethod
+    def hash_upload(data):
+        from hashlib import sha512
+        from config import max_upload_size, stream_chunk_size
+        hash_obj = sha512()
+        size = 0
+        while True:
+            block = data.read(stream_chunk_size)
+            if not block:
+                break
+            size += len(block)
+            assert size < max_upload_size, 'file too large (>={}B)'.format(
+                max_upload_size)
+            hash_obj.update(block)
+        return hash_obj.hexdigest(), size
+
+    """
+    定义了类方法 storage_target，按存储模式确定密文的内容键与加密密钥，
+    返回 (内容键, 文件密钥, 包装后的文件密钥, 存储布局)：
+    per_user 模式用用户自己的对称密钥加密，每个用户单独存储一份密文，文件密钥为 None；
+    convergent 模式用由内容与服务器密钥派生的文件密钥加密，全局只存储、签名一份密文，
+    文件密钥再用用户的对称密钥包装后保存在文件记录中；
+    chunked 模式在 convergent 的基础上按内容分块，每个块只存储一份。
+    """
+    @classmethod
+    def storage_target(cls, user, hash_value):
+        if storage_mode in ('convergent', 'chunked'):
+            file_key = secret.convergent_key(hash_value)
+            wrapped_key = secret.wrap_key(user.get_symmetric_key(), file_key)
+            if storage_mode == 'chunked':
+                return Blob.manifest_key(hash_value), file_key, wrapped_key, 'chunked'
+            return Blob.global_key(hash_value), file_key, wrapped_key, None
+        return Blob.user_key(user.id_, hash_value), None, None, None
+
+    """
+    定义了类方法 write_blob，回到上传内容的开头，用 file_key 分块加密并写入 key 对应的存储位置，
+    返回 (密文大小, 本次新写入的存储位置列表)。chunked 模式的 chunks 为 Blob.scan_chunks 的结果，
+    调用者需持有其中所有块的锁。
+    """
+    @classmethod
+    def write_blob(cls, key, file_key, layout, data, filename, chunks=None):
+        data.seek(0)
+        level = cls.compress_level(filename)
+        if layout == 'chunked':
+            return Blob.write_chunked(key, file_key, data, chunks, level)
+        return Blob.write(key, file_key, data, compress_level=level), [Blob.location_for(key)]
+
+    """
+    定义了静态方法 compress_level，根据文件类型决定加密前压缩明文使用的压缩级别，0 表示不压缩。
+    """
+    @staticmethod
+    def compress_level(filename):
+        from config import compress_level, compress_skip_suffix_list
+        suffix = filename.rsplit('.', maxsplit=1)[-1]
+        return 0 if suffix in compress_skip_suffix_list else compress_level
+
+    """
+    定义了类方法 add_record，用于创建文件记录并增加所引用密文的引用计数。
+    两者在同一个事务中提交；提交失败时回滚，并删除本次新写入的密文（cleanup 中的存储位置）。
+    """
+    @classmethod
+    def add_record(cls, user, filename, hash_value, key, size, wrapped_key=None, layout=None, cleanup=()):
+        try:
+            # 用户ID作为文件的创建者ID
+            file = File(creator_id=user.id_, filename=filename, hash_value=hash_value,
+                        wrapped_key=wrapped_key, layout=layout)
+            db.session.add(file)
+            Blob.acquire(key, Blob.location_for(key), size)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            Blob.discard(cleanup)
+            raise
+
+    """
+    定义了方法 content_key，返回解密该文件密文所需的对称密钥。
+    convergent 与 chunked 模式的文件先用用户的对称密钥解开包装后的文件密钥。
+    """
+    def content_key(self, user):
+        symmetric_key = user.get_symmetric_key()
+        if self.wrapped_key is not None:
+            return secret.unwrap_key(symmetric_key, self.wrapped_key)
+        return symmetric_key
+
+    """
+    定义了方法 plaintext_size，返回文件的明文大小。
+    chunked 模式的文件由 manifest 中各块的长度求和；旧格式的整块密文无法直接得知，返回 None。
+    """
+    def plaintext_size(self, user):
+        if self.layout == 'chunked':
+            return sum(size for _, size in Blob.read_manifest(self.blob_key, self.content_key(user)))
+        with Blob.open_ciphertext(Blob.locate(self.blob_key)) as f_:
+            info = secret.stream_header_info(
+                f_.read(secret.STREAM_HEADER.size))
+        return info and info[1]
+
+    """
+    定义了类方法 open_ticket，用于还原并校验 precheck 签发的上传凭证。
+    """
+    @classmethod
+    def open_ticket(cls, user, filename, ticket):
+        import json
+        from time import time
+
+        payload = secret.open_token(TICKET_PERSON, ticket)
+        assert payload, 'invalid ticket'
+        payload = json.loads(payload)
+        assert payload['user'] == user.id_ and payload['filename'] == filename, \
+            'invalid ticket'
+        assert payload['expires'] > time(), 'ticket expired'
+        return payload
 
     """
     定义了类方法 delete_file，用于删除文件
-    根据用户和文件名查找对应的文件记录，然后从数据库中删除该记录，并删除对应的文件和签名。
+    根据用户和文件名查找对应的文件记录，然后从数据库中删除该记录，
+    只有当密文不再被任何文件记录引用时，才删除对应的密文和签名。
     """
     @classmethod
     def delete_file(cls, user, filename):
@@ -116,64 +500,319 @@ class File(db.Model):
         # 断言文件记录存在，若不存在则抛出异常，提示找不到该文件
         assert f, 'no such file ({})'.format(filename)
 
-        # 获取文件的哈希值
-        hash_value = f.hash_value
-
-        # 删除文件记录，并将更改提交到数据库
-        db.session.delete(f)
-        db.session.commit()
-
-        
-        files = File.query.filter(File.hash_value == hash_value).all()
-
-        
-        if not len(files):
-            remove(storage_path+str(user.id_)+'/'+hash_value)
-            remove(storage_path+str(user.id_)+'/'+hash_value+'.sig')
+        # 尚未就绪的文件还没有引用密文，只删除文件记录，后台进程完成时会丢弃写入的密文
+        if f.status is not None:
+            db.session.delete(f)
+            db.session.commit()
+            return
+
+        # 从减少引用计数到删除存储中的对象，一直持有密文的锁（chunked 模式还有其中各块的锁），
+        # 同时上传相同内容的请求要么在提交之前复用这份密文，要么等删除完成之后重新写入
+        with Blob.lock([f.blob_key]):
+            entries = Blob.read_manifest(f.blob_key, f.content_key(user)) if f.layout == 'chunked' else []
+            with Blob.lock([Blob.chunk_key(chunk_hash) for chunk_hash, _ in entries]):
+                # 删除文件记录，并减少所引用密文的引用计数，两者在同一个事务中提交
+                # chunked 模式的 manifest 不再被引用时，同时减少其中各块的引用计数
+                db.session.delete(f)
+                if f.layout == 'chunked':
+                    locations = Blob.release_manifest(f.blob_key, f.content_key(user), entries)
+                else:
+                    locations = [Blob.release(f.blob_key)]
+                db.session.commit()
+
+                # 共享的文件可能在下载缓存中，提交后使其失效
+                if f.shared:
+                    blob_cache.invalidate(user.username, filename)
+
+                # 引用计数归零时，删除密文与签名
+                Blob.discard(locations)
+                if any(locations):
+                    blob_cache.discard(f.blob_key)
 
     """
     download_file方法,根据用户和文件名查找对应的文件记录,
-    然后根据下载类型（哈希值、签名、明文或加密文件）读取相应的内容，并构造响应以便下载
+    然后根据下载类型（哈希值、签名、明文或加密文件）构造下载响应。
+    签名从容器头部中取出，密文从容器中签名之后的部分原样发送，明文从存储中分块读取、逐块解密后产出，
+    都支持 HTTP Range 请求，便于客户端断点续传与并发分段下载。
+    响应带有由内容派生的强 ETag：签名与密文的 ETag 由签名派生（同名文件删除后重新上传时，
+    即使内容相同，随机的 nonce 也会使密文与签名变化），哈希值与明文的 ETag 由哈希值派生。
+    If-None-Match 匹配时直接返回 304，不读取密文。签名、密文与哈希值允许缓存 download_cache_max_age 秒，
+    解密后的明文每次使用前都要重新验证。public 为真时（下载公开的共享文件）反向代理也可以缓存，
+    有效期为 shared_download_cache_max_age 秒，默认每次都要重新验证，删除或取消共享后立即生效。
     """
     @classmethod
-    def download_file(cls, user, filename, type_):
-        from flask import make_response
+    def download_file(cls, user, filename, type_, public=False):
+        from config import download_cache_max_age, shared_download_cache_max_age
+        from common import content_etag, not_modified, set_cache_headers
         # 查询数据库，获取文件记录
         f = File.query.filter(
             and_(File.creator_id == user.id_, File.filename == filename)).first()
 
         # 断言文件记录存在，若不存在则抛出异常，提示找不到该文件
         assert f, 'no such file ({})'.format(filename)
+        assert f.status is None, 'file is not ready'
+
+        location = Blob.locate(f.blob_key)
+        signature = None
+        if type_ in ('signature', 'encrypted'):
+            # 签名从容器头部中取出（旧格式读取单独存储的 .sig），只需读取对象开头的一小段
+            signature = Blob.read_signature(location)
+            assert signature is not None, 'no signature ({})'.format(filename)
+            etag = content_etag(type_, signature)
+        else:
+            etag = content_etag(type_, f.hash_value.encode())
+        if public:
+            max_age = shared_download_cache_max_age
+        else:
+            max_age = 0 if type_ == 'plaintext' else download_cache_max_age
+
+        response = not_modified(etag, max_age, public)
+        if response is None:
+            response = cls.download_response(user, f, location, filename, type_, signature, etag)
+        return set_cache_headers(response, etag, max_age, public)
 
-        # 获取文件的哈希值
-        hash_value = f.hash_value
+    """
+    download_response方法，构造 download_file 的下载响应（不含缓存头部），
+    location 是密文的存储位置，signature 是签名、密文下载时已经读出的签名，etag 用于处理 If-Range。
+    """
+    @classmethod
+    def download_response(cls, user, f, location, filename, type_, signature, etag):
+        from os.path import getmtime
+        from flask import make_response
+        from common import make_range_response, make_file_response
+        backend = get_backend()
 
-        # 根据下载类型进行不同处理
+        # 哈希值很短，直接构造响应
         if type_ == 'hashvalue':
-            content = hash_value
-            filename = filename + '.hash'
-        elif type_ == 'signature':
-            # 读取签名
-            with open(storage_path+str(user.id_)+'/'+hash_value+'.sig', 'rb') as f_:
-                content = f_.read()
-                filename = filename+'.sig'
+            response = make_response(f.hash_value)
+            response.headers['Content-Disposition'] = 'attachment; filename={}'.format(
+                filename + '.hash')
+            return response
+
+        # chunked 模式的文件由 manifest 与各块组成，单独处理
+        if f.layout == 'chunked' and type_ != 'signature':
+            return cls.download_chunked(user, f, filename, type_, etag)
+
+        # 签名很短，直接构造响应
+        if type_ == 'signature':
+            return make_range_response(
+                lambda start, length: iter([signature[start:start+length]]),
+                len(signature), filename + '.sig', etag)
+
+        # 密文部分以文件对象的形式响应：本地存储时 WSGI 服务器可通过 wsgi.file_wrapper
+        # 使用 sendfile 从容器中密文的起始偏移处零拷贝发送；Range 请求定位到区间开头读取
+        if type_ == 'encrypted':
+            local_path = backend.local_path(location)
+            last_modified = int(getmtime(local_path)) if local_path is not None else None
+            ciphertext = Blob.open_ciphertext(location)
+            return make_file_response(ciphertext, ciphertext.length, filename + '.encrypted',
+                                      last_modified, etag)
+
+        # 解密并下载明文。先还原出对称密钥，再读取密文头部得到明文长度
+        symmetric_key = f.content_key(user)
+        with Blob.open_ciphertext(location) as f_:
+            info = secret.stream_header_info(
+                f_.read(secret.STREAM_HEADER.size))
+        if info is None:
+            # 旧格式的整块密文只能整体解密
+            with Blob.open_ciphertext(location) as f_:
+                content = secret.symmetric_decrypt(symmetric_key, f_.read())
+            return make_range_response(
+                lambda start, length: iter([content[start:start+length]]),
+                len(content), filename, etag)
+
+        def generate(start, length):
+            with Blob.open_ciphertext(location) as f_:
+                yield from secret.symmetric_decrypt_range(symmetric_key, f_, start, length)
+
+        return make_range_response(generate, info[1], filename, etag)
+
+    """
+    download_shared方法，下载用户 username 共享的文件的密文或签名（type_ 为 'encrypted' 或 'signature'）。
+    热门的共享文件由 blob_cache 缓存，命中时不查询数据库、不读取存储；未命中时确认文件仍在共享后按 download_file 下载，
+    近期访问次数达到准入条件、大小不超过单个文件上限的共享文件读出密文与签名放入缓存。
+    """
+    @classmethod
+    def download_shared(cls, username, filename, type_):
+        from .user import User
+        if blob_cache.enabled:
+            # 在查询数据库之前取得失效代数，查询期间文件被删除或取消共享时不放入缓存
+            generation = blob_cache.generation()
+            cached = blob_cache.get(username, filename)
+            if cached is not None:
+                return cls.cached_response(cached, filename, type_)
+
+        user = User.get_by(username=username)
+        assert user, 'no such user ({})'.format(username)
+        # 只能下载仍在共享的文件
+        f = File.query.filter(
+            and_(File.creator_id == user.id_, File.filename == filename)).first()
+        assert f and f.shared, 'no such shared file ({})'.format(filename)
+        if blob_cache.enabled:
+            if f.status is None and blob_cache.admit(f.blob_key) \
+                    and f.ciphertext_size(user) <= blob_cache.max_item_bytes:
+                cached = (b''.join(f.iter_content(user, 'signature')),
+                          b''.join(f.iter_content(user, 'encrypted')))
+                blob_cache.put(username, filename, f.blob_key, *cached, generation)
+                return cls.cached_response(cached, filename, type_)
+        return cls.download_file(user, filename, type_, public=True)
+
+    # 用内存中的 (签名, 密文) 构造下载响应，支持 HTTP Range 请求，ETag 与缓存头部与 download_file 一致
+    @staticmethod
+    def cached_response(cached, filename, type_):
+        from config import shared_download_cache_max_age
+        from common import make_range_response, content_etag, not_modified, set_cache_headers
+        signature, ciphertext = cached
+        etag = content_etag(type_, signature)
+        response = not_modified(etag, shared_download_cache_max_age, public=True)
+        if response is not None:
+            return response
+        if type_ == 'signature':
+            data, filename = signature, filename + '.sig'
         else:
-            # 读取密文
-            with open(storage_path+str(user.id_)+'/'+hash_value, 'rb') as f_:
-                content = f_.read()
-            if type_ == 'plaintext':
-                content = secret.symmetric_decrypt(
-                    secret.decrypt(user.encrypted_symmetric_key), content)
-            elif type_ == 'encrypted':
-                filename = filename + '.encrypted'
+            data, filename = ciphertext, filename + '.encrypted'
+        response = make_range_response(
+            lambda start, length: iter([data[start:start+length]]), len(data), filename, etag)
+        return set_cache_headers(response, etag, shared_download_cache_max_age, public=True)
+
+    # 对外提供的密文的大致大小，用于下载缓存的准入控制：
+    # 整块密文为存储的对象大小，chunked 模式的文件为明文大小
+    def ciphertext_size(self, user):
+        if self.layout == 'chunked':
+            return self.plaintext_size(user)
+        blob = Blob.get(self.blob_key)
+        return blob.size if blob is not None and blob.size is not None else 0
+
+    """
+    download_chunked方法，下载 chunked 模式的文件。
+    密文为 manifest 密文与各块密文按顺序的拼接，从存储中依次读取各个对象；
+    明文按 manifest 逐块解密，Range 请求只读取覆盖区间的块。
+    """
+    @classmethod
+    def download_chunked(cls, user, f, filename, type_, etag=None):
+        from common import make_range_response
+        from config import stream_chunk_size
+        backend = get_backend()
+        file_key = f.content_key(user)
+        entries = Blob.read_manifest(f.blob_key, file_key)
+        chunk_locations = Blob.locate_many([Blob.chunk_key(chunk_hash) for chunk_hash, _ in entries])
+
+        if type_ == 'encrypted':
+            # 各部分的 (存储位置, 密文在对象中的起始偏移, 长度)，manifest 的密文在容器头部之后
+            parts = []
+            for location in [Blob.locate(f.blob_key)] + chunk_locations:
+                with backend.open(location) as f_:
+                    offset, _ = Blob.read_container(f_)
+                parts.append((location, offset, backend.size(location) - offset))
+
+            def generate(start, length):
+                for location, offset, size in parts:
+                    if start >= size:
+                        start -= size
+                        continue
+                    n = min(length, size - start)
+                    yield from backend.iter_range(location, offset + start, n, stream_chunk_size)
+                    start, length = 0, length - n
+                    if length <= 0:
+                        break
+
+            return make_range_response(generate, sum(size for _, _, size in parts),
+                                       filename + '.encrypted', etag)
+
+        def generate(start, length):
+            for (chunk_hash, size), location in zip(entries, chunk_locations):
+                if start >= size:
+                    start -= size
+                    continue
+                n = min(length, size - start)
+                with backend.open(location) as f_:
+                    yield from secret.symmetric_decrypt_range(
+                        secret.convergent_key(chunk_hash), f_, start, n)
+                start, length = 0, length - n
+                if length <= 0:
+                    break
+
+        return make_range_response(generate, sum(size for _, size in entries), filename, etag)
 
-        # 创建下载响应
-        response = make_response(content)
+    """
+    定义了方法 iter_content，返回逐块产出文件内容的迭代器，type_ 为 'encrypted'、'signature' 或 'plaintext'。
+    密钥与存储位置在调用时就确定下来，迭代器只读取存储，可以在请求结束、数据库会话关闭后继续使用。
+    """
+    def iter_content(self, user, type_):
+        from config import stream_chunk_size
+        location = Blob.locate(self.blob_key)
+
+        if type_ == 'plaintext':
+            # 解密明文：chunked 模式的文件按 manifest 逐块解密
+            file_key = self.content_key(user)
+            if self.layout == 'chunked':
+                entries = Blob.read_manifest(self.blob_key, file_key)
+                locations = Blob.locate_many([Blob.chunk_key(chunk_hash) for chunk_hash, _ in entries])
+                parts = [(location_, secret.convergent_key(chunk_hash))
+                         for (chunk_hash, _), location_ in zip(entries, locations)]
+            else:
+                parts = [(location, file_key)]
+
+            def generate():
+                for location_, key in parts:
+                    with Blob.open_ciphertext(location_) as f:
+                        yield from secret.symmetric_decrypt_stream(key, f)
+            return generate()
+
+        # 签名从容器头部中取出，读取时就确定下来
+        if type_ == 'signature':
+            return iter([Blob.read_signature(location) or b''])
+
+        # 密文原样读出；chunked 模式的密文为 manifest 密文与各块密文的拼接
+        locations = [location]
+        if self.layout == 'chunked':
+            locations += Blob.locate_many([Blob.chunk_key(chunk_hash) for chunk_hash, _ in
+                                           Blob.read_manifest(self.blob_key, self.content_key(user))])
+
+        def generate():
+            for location_ in locations:
+                with Blob.open_ciphertext(location_) as f:
+                    yield from iter(lambda: f.read(stream_chunk_size), b'')
+        return generate()
 
-        # 设置响应头部，指定下载文件的文件名
-        response.headers['Content-Disposition'] = 'attachment; filename={}'.format(
-            filename)
+    """
+    定义了类方法 export_files，把多个文件打包成一个 ZIP 压缩包下载。filenames 为空时导出该用户的所有文件。
+    type_ 为 'encrypted' 时每个文件导出密文与签名文件，为 'plaintext' 时导出解密后的明文。
+    压缩包边生成边发送，各文件逐块读取，不会在内存中组装完整的压缩包。
+    """
+    @classmethod
+    def export_files(cls, user, filenames, type_):
+        from flask import Response
+        from config import compress_skip_suffix_list
+        from common import iter_zip
+
+        if filenames:
+            files = []
+            for filename in filenames:
+                f = File.query.filter(
+                    and_(File.creator_id == user.id_, File.filename == filename)).first()
+                assert f, 'no such file ({})'.format(filename)
+                assert f.status is None, 'file is not ready ({})'.format(filename)
+                files.append(f)
+        else:
+            files = File.query.filter(
+                and_(File.creator_id == user.id_, File.status.is_(None))).all()
+            assert files, 'no file to export'
 
+        # 密文无法再压缩，直接存储；明文中本身已经压缩过的文件类型也直接存储
+        members = []
+        for f in files:
+            if type_ == 'plaintext':
+                suffix = f.filename.rsplit('.', maxsplit=1)[-1]
+                members.append((f.filename, f.iter_content(user, 'plaintext'),
+                                suffix not in compress_skip_suffix_list))
+            else:
+                members.append((f.filename+'.encrypted', f.iter_content(user, 'encrypted'), False))
+                members.append((f.filename+'.sig', f.iter_content(user, 'signature'), False))
+
+        response = Response(iter_zip(members), mimetype='application/zip',
+                            direct_passthrough=True)
+        response.headers['Content-Disposition'] = 'attachment; filename=export.zip'
         return response
 
     @classmethod
@@ -184,7 +823,10 @@ class File(db.Model):
         
         # 断言文件记录存在，若不存在则抛出异常，提示找不到该文件
         assert f, 'no such file ({})'.format(filename)
+        assert f.status is None, 'file is not ready'
         # 切换文件的共享状态，将 shared 属性取反
         f.shared = not f.shared
         # 提交更改到数据库
         db.session.commit()
+        # 取消共享后不能再从下载缓存中下载
+        blob_cache.invalidate(user.username, filename)
@@ -4,6 +4,10 @@
 
 函数 create_record(cls, id_)，用于创建在线用户记录
 
+函数 renew_record(cls, record)，按滑动续期策略决定是否为已验证的在线用户记录更换令牌
+
+函数 revoke_record(cls, record)，用户登出时作废令牌
+
 函数 delete_record(cls, id_)，用于删除在线用户记录
 
 函数 get_by(cls, **kwargs)，用于根据指定条件查询在线用户记录。
@@ -12,15 +16,30 @@
 函数 verify_token(cls, token) 用于验证令牌是否有效,config中规定了一个期限
 根据上面函数查询出的在线用户记录 用现在的时间减去上次登陆时间，
 若大于期限，则判断用户长时间未登陆则表示令牌无效
+
+config 中 session_mode = 'stateless' 时，令牌不再存储在 online_users 表中，
+而是由服务器密钥加密认证的一段数据，包含用户ID、签发时间、过期时间和登录编号，
+验证时只需解密校验，不查询数据库。登录编号在登录时生成，滑动续期换发的令牌沿用同一个编号；
+主动登出时把登录编号记入 revoked_tokens 表，这次登录换发过的所有令牌同时作废。
+这种模式下各函数返回的在线用户记录只是内存中的对象，不会写入数据库。
 """
 
 
 from sqlalchemy import Column, String, Integer, ForeignKey
 from sqlalchemy import TIMESTAMP
+from sqlalchemy.exc import IntegrityError
 #从自定义的 database 模块中导入了 db 对象
 #该对象是 SQLAlchemy 的数据库对象，用于与数据库进行交互。
 from database import db
+from config import session_mode
 from common import *
+import struct
+import secret
+
+# 无状态令牌的内容：用户ID(8) 签发时间(4) 过期时间(4) 登录编号(8)
+STATELESS_TOKEN = struct.Struct('>QII8s')
+# 无状态令牌使用的派生密钥用途
+SESSION_PERSON = b'session-token'
 
 
 #定义了一个名为 OnlineUser 的数据库模型类
@@ -30,41 +49,26 @@ class OnlineUser(db.Model):
     # 定义表名字为 online_users
     # 定义了三个参数
     # 第一个为 id,关联到 users 表的 id_ 列,自增
-    # 第二个为 token，存储用户的唯一对应令牌
-    # 第三个为 last_used,用于记录用户最后一次使用的时间。
+    # 第二个为 token，存储用户的唯一对应令牌，带唯一索引，由数据库保证不会重复
+    # 第三个为 last_used,用于记录令牌签发（最近一次续期）的时间。
 
     __tablename__ = 'online_users'
     id_ = Column(Integer, ForeignKey('users.id_'), primary_key=True, autoincrement=True)
-    token = Column(String(32), primary_key=True)
+    token = Column(String(32), primary_key=True, index=True, unique=True)
     last_used = Column(TIMESTAMP)
 
     @classmethod
 
-    # 用于生成一个新的可用令牌（token）。
-    # 并从数据库中获取所有记录，并将 token 存储在列表中。
-    # 然后，生成新的 token
-    # 并检查是否与数据库中已有的 token 冲突
-    # 如果没有冲突，则返回这个新的 token。
+    # 用于生成一个新的令牌（token）。
+    # uuid4 有 122 位随机数，冲突的概率可以忽略，
+    # 不再查询已有的令牌，由 token 列的唯一索引兜底，冲突时由 create_record 重试。
 
     def new_available_token(cls):
 
         # uuid4 用于生成一个随机的 UUID.
         from uuid import uuid4
 
-        # 数据库查询，返回 OnlineUser 类中所有的记录
-        record_list = cls.query.all()
-
-        # 通过列表推导式，提取所有记录的 token 字段，
-        token_list = list(record.token for record in record_list)
-
-        # 生成令牌，与原令牌对比
-        # 无限循环，知道找到一个可用的新令牌
-        while True:
-            token = uuid4().hex
-            if token not in token_list:
-                record = cls.query.filter(cls.token == token).first()
-                if record is None:
-                    return token
+        return uuid4().hex
 
 
 
@@ -75,35 +79,110 @@ class OnlineUser(db.Model):
         # 用于获取当前的日期和时间信息。
         from datetime import datetime
 
-        # 生成一个新的可用令牌。
-        token = cls.new_available_token()
+        # 无状态模式下直接签发令牌，不写数据库
+        if session_mode == 'stateless':
+            return cls.issue_stateless(id_)
 
-        # 获取具有指定 id_ 的在线用户记录。
-        record = cls.get_by(id_=id_)
+        # 令牌与已有令牌冲突时，唯一索引会使提交失败，回滚后换一个令牌重试
+        for _ in range(3):
+
+            # 生成一个新的令牌。
+            token = cls.new_available_token()
+
+            # 获取具有指定 id_ 的在线用户记录。
+            record = cls.get_by(id_=id_)
+
+            # 检查指定id_的在线用户记录是否存在
+            # 如果不存在，说明该用户没有在线记录
+            # 则需要创建一个新的 OnlineUser 记录。
+            if record is None:
+                record = OnlineUser(id_=id_, token=token)
+
+                # 创建一个新的 OnlineUser 记录，
+                record.last_used = datetime.now()
+
+                # 将新创建的记录添加到数据库会话中。
+                db.session.add(record)
+
+            # 存在在线记录 
+            # 更新
+            else:
+                record.token = token
+                record.last_used = datetime.now()
 
-        # 检查指定id_的在线用户记录是否存在
-        # 如果不存在，说明该用户没有在线记录
-        # 则需要创建一个新的 OnlineUser 记录。
-        if record is None:
-            record = OnlineUser(id_=id_, token=token)
+            #提交数据库会话
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                continue
 
-            # 创建一个新的 OnlineUser 记录，
-            record.last_used = datetime.now()
+            #返回生成的令牌 token。
+            return token
 
-            # 将新创建的记录添加到数据库会话中。
-            db.session.add(record)
+        raise RuntimeError('failed to issue a unique token')
 
-        # 存在在线记录 
-        # 更新
+    # 滑动续期：令牌签发后经过的时间达到 token_expired 的 token_renew_ratio 比例时，
+    # 才更换令牌并更新 last_used，否则继续使用原令牌，不写数据库
+    @classmethod
+    def renew_record(cls, record):
+        from datetime import datetime
+        from config import token_expired, token_renew_ratio
+
+        elapsed = (datetime.now() - record.last_used).total_seconds()
+        if elapsed >= token_expired * token_renew_ratio:
+            # 无状态模式换发的令牌沿用原令牌的登录编号
+            if session_mode == 'stateless':
+                _, _, _, login = STATELESS_TOKEN.unpack(
+                    secret.open_token(SESSION_PERSON, record.token))
+                return cls.issue_stateless(record.id_, login)
+            return cls.create_record(record.id_)
+        return record.token
+
+    # 用户登出时作废令牌：数据库模式删除在线用户记录，无状态模式把登录编号记入作废表。
+    # 之前续期换发的令牌仍未过期，作废登录编号使它们一起失效；
+    # 换发的令牌最晚在 token_expired 秒后过期，作废记录保留到那时
+    @classmethod
+    def revoke_record(cls, record):
+        from datetime import datetime, timedelta
+        from config import token_expired
+        from .revoked_token import RevokedToken
+
+        if session_mode == 'stateless':
+            _, _, _, login = STATELESS_TOKEN.unpack(
+                secret.open_token(SESSION_PERSON, record.token))
+            RevokedToken.revoke(login.hex(), datetime.now() + timedelta(seconds=token_expired))
         else:
-            record.token = token
-            record.last_used = datetime.now()
+            cls.delete_record(record.id_)
 
-        #提交数据库会话
-        db.session.commit()
+    # 签发无状态令牌，令牌由服务器的派生密钥加密认证，客户端无法伪造或修改。
+    # login 为登录编号，登录时为 None，随机生成新的编号
+    @classmethod
+    def issue_stateless(cls, id_, login=None):
+        from time import time
+        from nacl.utils import random
+        from config import token_expired
 
-        #返回生成的令牌 token。
-        return token
+        now = int(time())
+        payload = STATELESS_TOKEN.pack(id_, now, now + token_expired, login or random(8))
+        return secret.seal_token(SESSION_PERSON, payload)
+
+    # 验证无状态令牌：解密校验、检查是否过期，只有作废集合需要定期从数据库刷新
+    @classmethod
+    def verify_stateless(cls, token):
+        from time import time
+        from datetime import datetime
+        from .revoked_token import RevokedToken
+
+        payload = secret.open_token(SESSION_PERSON, token)
+        if payload is None or len(payload) != STATELESS_TOKEN.size:
+            return None
+        id_, issued, expires, login = STATELESS_TOKEN.unpack(payload)
+        if time() >= expires or RevokedToken.is_revoked(login.hex()):
+            return None
+
+        # 返回内存中的在线用户记录，last_used 为令牌的签发时间，供滑动续期使用
+        return OnlineUser(id_=id_, token=token, last_used=datetime.fromtimestamp(issued))
 
     @classmethod
     # 用于删除在线用户记录。
@@ -142,6 +221,10 @@ class OnlineUser(db.Model):
         # 该变量是指定令牌的有效期限，以秒为单位。
         from config import token_expired
 
+        # 无状态模式下不查询数据库
+        if session_mode == 'stateless':
+            return cls.verify_stateless(token) if token else None
+
         # 查询数据库具有指定 token 的在线用户记录。
         record = cls.get_by(token=token)
 
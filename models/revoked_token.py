@@ -0,0 +1,65 @@
+"""
+此文件定义了 RevokedToken 类，记录无状态会话模式（session_mode = 'stateless'）下
+用户主动登出而提前作废的登录：记录的是令牌中的登录编号，这次登录续期换发过的令牌都被作废。
+
+无状态令牌本身带有过期时间，验证时不查询数据库；只有主动登出的令牌需要记入本表，
+记录在令牌过期后即可清除，因此表中只有很少的记录。
+
+函数 revoke(cls, jti, expires)，作废一次登录换发的所有令牌
+
+函数 is_revoked(cls, jti)，判断登录是否已被作废。
+每个进程在内存中缓存作废集合，每隔 revocation_refresh 秒才从数据库重新加载一次，
+因此验证令牌时通常不需要访问数据库。
+"""
+
+
+from sqlalchemy import Column, String, TIMESTAMP
+from threading import Lock
+from database import db
+
+
+class RevokedToken(db.Model):
+
+    # 定义表名为 revoked_tokens
+    # 第一个参数为 jti，令牌中的登录编号
+    # 第二个参数为 expires，这次登录换发的令牌最晚的过期时间，过期后记录可以删除
+
+    __tablename__ = 'revoked_tokens'
+    jti = Column(String(16), primary_key=True)
+    expires = Column(TIMESTAMP, nullable=False)
+
+    # 进程内缓存的作废集合及其加载时间
+    _cache = set()
+    _loaded_at = 0
+    _lock = Lock()
+
+    @classmethod
+    def revoke(cls, jti, expires):
+        from datetime import datetime
+
+        # 顺便清除已经过期的记录
+        cls.query.filter(cls.expires < datetime.now()).delete()
+        if cls.query.filter_by(jti=jti).first() is None:
+            db.session.add(RevokedToken(jti=jti, expires=expires))
+        db.session.commit()
+
+        # 本进程立即生效，其他进程在下一次刷新后生效
+        with cls._lock:
+            cls._cache.add(jti)
+
+    @classmethod
+    def is_revoked(cls, jti):
+        from time import time
+        from datetime import datetime
+        from config import revocation_refresh
+
+        with cls._lock:
+            stale = time() - cls._loaded_at >= revocation_refresh
+        if stale:
+            # 重新加载尚未过期的作废记录
+            rows = db.session.query(cls.jti).filter(
+                cls.expires >= datetime.now()).all()
+            with cls._lock:
+                cls._cache = set(jti for jti, in rows)
+                cls._loaded_at = time()
+        return jti in cls._cache
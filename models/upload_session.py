@@ -0,0 +1,164 @@
+"""
+此文件定义了 UploadSession 类，用于断点续传：大文件分成若干块上传，
+连接中断后只需重新上传缺少的块。
+
+上传流程：创建上传会话 -> 按任意顺序上传编号的块 -> 查询已收到的块 -> 完成上传。
+已收到的块用用户的对称密钥加密后暂存在存储后端的 staging/ 下，不以明文落盘；
+暂存的块与密文使用同一个存储后端，多个 Web 节点可以分别接收同一个会话的块；
+完成上传时按顺序逐块解密，交给 File.upload_file 计算哈希、秒传判断并流式加密为正式的密文。
+
+函数 create(cls, user, filename, size, ticket)，创建上传会话并校验上传凭证，同时清除过期的会话
+
+函数 get_for(cls, user, id_)，查询属于该用户且未过期的上传会话
+
+函数 put_chunk(self, user, index, data)，保存第 index 块
+
+函数 received(self)，返回已收到的块的编号列表
+
+函数 finalize(self, user)，所有块都收到后完成上传，并删除会话
+
+函数 discard(self)，删除会话及其暂存的块
+"""
+
+
+from sqlalchemy import Column, String, Integer, BigInteger, ForeignKey
+from sqlalchemy import TIMESTAMP
+from database import db
+from backends import get_backend
+from common import IterReader
+import secret
+
+# 暂存上传块的存储位置前缀
+STAGING_PREFIX = 'staging/'
+
+
+class UploadSession(db.Model):
+    """
+    定义表 upload_sessions
+    字段有:会话ID（随机生成）、用户ID、文件名、文件大小、分块大小、秒传预检查的上传凭证中声明的哈希值和过期时间。
+    """
+    __tablename__ = 'upload_sessions'
+    id_ = Column(String(32), primary_key=True)
+    user_id = Column(Integer, ForeignKey(
+        'users.id_', ondelete='CASCADE'), nullable=False, index=True)
+    filename = Column(String(64), nullable=False)
+    size = Column(BigInteger, nullable=False)
+    chunk_size = Column(Integer, nullable=False)
+    hash_value = Column(String(128))
+    expires = Column(TIMESTAMP, nullable=False)
+
+    # 暂存该会话的块的存储位置前缀，第 index 块存储在该前缀加上 index
+    @property
+    def staging_prefix(self):
+        return STAGING_PREFIX + self.id_ + '/'
+
+    # 块数，空文件也有一个空块
+    @property
+    def count(self):
+        return max(1, -(-self.size // self.chunk_size))
+
+    # 第 index 块的长度，只有最后一块可以不足分块大小
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    @classmethod
+    def create(cls, user, filename, size, ticket=None):
+        from uuid import uuid4
+        from datetime import datetime, timedelta
+        from config import max_upload_size, upload_chunk_size, upload_session_expired
+        from .file import File
+
+        # 顺便清除已经过期的会话
+        cls.purge_expired()
+
+        # 提前做与 upload_file 相同的校验，避免上传完所有块后才失败
+        File.check_upload(user, filename)
+        assert 0 <= size < max_upload_size, 'file too large (>={}B)'.format(
+            max_upload_size)
+
+        # 上传凭证在创建会话时校验，会话中只记录凭证声明的哈希值（大小即会话的大小）。
+        # 会话的有效期比凭证长，完成上传时核对内容与声明一致，不再检查凭证是否过期
+        hash_value = None
+        if ticket:
+            claim = File.open_ticket(user, filename, ticket)
+            assert claim['size'] == size, 'size does not match ticket'
+            hash_value = claim['hash_value']
+
+        session = UploadSession(id_=uuid4().hex, user_id=user.id_, filename=filename,
+                                size=size, chunk_size=upload_chunk_size, hash_value=hash_value,
+                                expires=datetime.now() + timedelta(seconds=upload_session_expired))
+        db.session.add(session)
+        db.session.commit()
+        return session
+
+    # 会话ID是随机生成的，只有创建会话的用户知道，
+    # 因此上传块、完成上传的请求不需要另外的 CSRF 令牌
+    @classmethod
+    def get_for(cls, user, id_):
+        from datetime import datetime
+        session = cls.query.filter_by(id_=id_, user_id=user.id_).first()
+        assert session and session.expires > datetime.now(), 'no such upload session'
+        return session
+
+    def put_chunk(self, user, index, data):
+        assert 0 <= index < self.count, 'invalid chunk index'
+        assert len(data) == self.chunk_length(index), 'invalid chunk length'
+
+        # 整块一次写入，中断的写入不会被当作已收到的块
+        get_backend().put(self.staging_prefix + str(index),
+                          secret.symmetric_encrypt(user.get_symmetric_key(), data))
+
+    def received(self):
+        names = (location[len(self.staging_prefix):]
+                 for location in get_backend().list(self.staging_prefix))
+        return sorted(int(name) for name in names if name.isdigit())
+
+    def finalize(self, user):
+        from .file import File
+        missing = set(range(self.count)) - set(self.received())
+        assert not missing, 'missing chunks: {}'.format(
+            ','.join(str(index) for index in sorted(missing)))
+
+        # 与表单上传走同一个流程：计算哈希、核对凭证声明的哈希值与大小、判断密文是否已存在、流式加密
+        claim = dict(hash_value=self.hash_value, size=self.size) if self.hash_value else None
+        File.upload_file(user, StagedUpload(self, user.get_symmetric_key()), claim=claim)
+        self.discard()
+
+    def discard(self):
+        get_backend().delete_prefix(self.staging_prefix)
+        db.session.delete(self)
+        db.session.commit()
+
+    @classmethod
+    def purge_expired(cls):
+        from datetime import datetime
+        for session in cls.query.filter(cls.expires < datetime.now()).all():
+            get_backend().delete_prefix(session.staging_prefix)
+            db.session.delete(session)
+        db.session.commit()
+
+
+class StagedUpload:
+    """
+    把暂存的块按顺序解密拼接成只读的文件对象，提供 File.upload_file 需要的
+    filename 属性与 read、seek 方法。upload_file 读完一遍计算哈希后会回到开头再读一遍，
+    因此只支持 seek(0)，回到开头时重新逐块解密。
+    """
+
+    def __init__(self, session, symmetric_key):
+        self.filename = session.filename
+        self._session = session
+        self._key = symmetric_key
+        self.seek(0)
+
+    def _chunks(self):
+        for index in range(self._session.count):
+            with get_backend().open(self._session.staging_prefix + str(index)) as f:
+                yield secret.symmetric_decrypt(self._key, f.read())
+
+    def seek(self, offset):
+        assert offset == 0, 'staged upload can only be rewound'
+        self._reader = IterReader(self._chunks())
+
+    def read(self, size=-1):
+        return self._reader.read(size)
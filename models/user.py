@@ -5,6 +5,7 @@
 
 get_by(cls, **kwargs)实现查询操作，用于创建用户
 create_user(cls, username, hash_password)实现了用户的创建
+get_symmetric_key(self)返回解密后的用户对称密钥，解密结果缓存在进程内
 """
 
 
@@ -12,6 +13,11 @@ from sqlalchemy import Column, String, Integer, LargeBinary
 from sqlalchemy import TIMESTAMP
 from sqlalchemy.sql import func
 from database import db
+from config import key_cache_entries, key_cache_bytes, key_cache_ttl, key_cache_shared_path
+from key_cache import KeyCache
+
+# 进程内的用户对称密钥缓存，统计信息可通过 key_cache.stats() 或 manage.py key-cache-stats 查看
+key_cache = KeyCache(key_cache_entries, key_cache_bytes, key_cache_ttl, key_cache_shared_path)
 
 
 # 定义了一个名为 user 的数据库模型类
@@ -50,6 +56,12 @@ class User(db.Model):
 
 
 
+    # 返回解密后的用户对称密钥
+    # 缓存以加密后的密钥作为校验值，密钥更换后不会返回旧的密钥
+    def get_symmetric_key(self):
+        import secret
+        return key_cache.get(self.id_, self.encrypted_symmetric_key, secret.decrypt)
+
     # 用于创建新的用户记录并将其存储到数据库中。
 
     @classmethod
@@ -5,8 +5,18 @@ from nacl.public import PrivateKey, SealedBox
 from nacl.signing import SigningKey
 from nacl.secret import SecretBox
 from nacl.utils import random
+from nacl.hash import blake2b
+from nacl.encoding import RawEncoder, URLSafeBase64Encoder
+from nacl.exceptions import CryptoError, BadSignatureError
 from os.path import exists
-from config import nacl_sk_path
+from io import BytesIO
+from collections import namedtuple
+from threading import Lock
+import struct
+import hashlib
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from config import nacl_sk_path, crypto_threads
 
 # 代码检查一个路径是否存在
 # 如果不存在，就生成一个私钥（PrivateKey）并保存到指定的路径中。
@@ -21,29 +31,132 @@ else:
     with open(nacl_sk_path, 'rb') as f:
         sk_raw = f.read()
 
+# 由私钥构造的密钥对象：构造 PrivateKey/SigningKey 时都要做一次标量乘法推导公钥，
+# 因此只在第一次使用时构造一次，之后所有调用共用。这些对象只读，可以在多个线程中同时使用
+
+
+_Keys = namedtuple('_Keys', 'private_key public_key signing_key verify_key seal_box open_box')
+_keys = None
+_keys_lock = Lock()
+
+
+def _get_keys():
+    global _keys
+    if _keys is None:
+        with _keys_lock:
+            # 加锁后再检查一次，避免多个线程重复构造
+            if _keys is None:
+                private_key = PrivateKey(sk_raw)
+                signing_key = SigningKey(sk_raw)
+                _keys = _Keys(private_key, private_key.public_key,
+                              signing_key, signing_key.verify_key,
+                              SealedBox(private_key.public_key), SealedBox(private_key))
+    return _keys
+
 # 使用 SealedBox 加密传入的明文
 
 
 def encrypt(plaintext: bytes):
-    return SealedBox(PrivateKey(sk_raw).public_key).encrypt(plaintext)
+    return _get_keys().seal_box.encrypt(plaintext)
 
 # 使用 SealedBox 解密传入的密文
 
 
 def decrypt(ciphertext: bytes):
-    return SealedBox(PrivateKey(sk_raw)).decrypt(ciphertext)
+    return _get_keys().open_box.decrypt(ciphertext)
 
 # 对传入的消息（message）进行签名，并返回签名（signature）
 
 
 def sign(message: bytes):
-    return SigningKey(sk_raw).sign(message).signature
+    return _get_keys().signing_key.sign(message).signature
 
 # 用公钥（verify_key）验证传入的消息（message）和签名（signature）是否匹配
 
 
 def verify(message: bytes, signature: bytes):
-    return SigningKey(sk_raw).verify_key.verify(message, signature)
+    return _get_keys().verify_key.verify(message, signature)
+
+# 批量签名，返回与 messages 顺序一致的签名列表，用于重新签名整个存储目录等批量任务
+
+
+def sign_many(messages):
+    signing_key = _get_keys().signing_key
+    return [signing_key.sign(message).signature for message in messages]
+
+# 批量验证 (消息, 签名) 对，返回与输入顺序一致的布尔值列表；
+# 与 verify 不同，签名不匹配时不抛出异常，便于一次检查大量文件
+
+
+def verify_many(pairs):
+    verify_key = _get_keys().verify_key
+    results = []
+    for message, signature in pairs:
+        try:
+            verify_key.verify(message, signature)
+            results.append(True)
+        except (BadSignatureError, ValueError):
+            results.append(False)
+    return results
+
+# 版本化的签名文件（.sig）：
+# 旧版本的签名文件只有 64 字节的签名，签名对象是完整的密文，签名时需要把整个密文读入内存。
+# 版本 2 的签名文件为 魔数(7) 版本(1) 头部长度(4) 签名(64)，签名对象是密文的摘要：
+#   body = BLAKE2b-512(密文[头部长度:])，person 为 SIG_BODY_PERSON
+#   digest = BLAKE2b-512(头部长度(4) + 密文[:头部长度] + body)，person 为 SIG_PERSON
+# 摘要使用专用的 person 与其他用途的哈希区分。密文头部单独计入摘要，
+# 因此可以先边写入边计算后面的密文块的摘要，最后再补上回填后的头部，签名只需常数内存。
+SIG_MAGIC = b'CUCSIG\x00'
+SIG_VERSION = 2
+SIG_HEADER = struct.Struct('>7sBI')
+SIG_PERSON = b'cuc-sig-v2'
+SIG_BODY_PERSON = b'cuc-sig-v2-body'
+SIGNATURE_SIZE = 64
+
+
+class StreamSigner:
+
+    # 密文头部可以在任意时候通过 set_head 设置，其余密文按顺序传给 update
+    def __init__(self, head: bytes = b''):
+        self.head = head
+        self._body = hashlib.blake2b(digest_size=64, person=SIG_BODY_PERSON)
+
+    def set_head(self, head: bytes):
+        self.head = head
+
+    def update(self, data: bytes):
+        self._body.update(data)
+
+    def digest(self):
+        outer = hashlib.blake2b(digest_size=64, person=SIG_PERSON)
+        outer.update(struct.pack('>I', len(self.head)))
+        outer.update(self.head)
+        outer.update(self._body.digest())
+        return outer.digest()
+
+    # 返回签名文件的内容
+    def finish(self):
+        return SIG_HEADER.pack(SIG_MAGIC, SIG_VERSION, len(self.head)) + sign(self.digest())
+
+# 逐块读取 src 中的密文，验证 signature_file（签名文件的内容）是否匹配，返回布尔值
+# 同时支持旧版本只有签名的签名文件，旧版本需要把整个密文读入内存
+
+
+def verify_stream(src, signature_file: bytes):
+    if len(signature_file) == SIGNATURE_SIZE:
+        return verify_many([(src.read(), signature_file)])[0]
+    if len(signature_file) != SIG_HEADER.size + SIGNATURE_SIZE:
+        return False
+    magic, version, head_size = SIG_HEADER.unpack(signature_file[:SIG_HEADER.size])
+    if magic != SIG_MAGIC or version != SIG_VERSION:
+        return False
+    signer = StreamSigner(_read_full(src, head_size))
+    while True:
+        data = src.read(1024*1024)
+        if not data:
+            break
+        signer.update(data)
+    return verify_many([(signer.digest(), signature_file[SIG_HEADER.size:])])[0]
 
 # 生成一个新的对称密钥（symmetric_key）
 
@@ -58,16 +171,270 @@ def symmetric_encrypt(symmetric_key: bytes, plaintext: bytes):
     return SecretBox(symmetric_key).encrypt(plaintext)
 
 # 使用生成的对称密钥对传入的密文进行解密
+# 同时兼容整块 SecretBox 密文与分块流式密文
 
 
 def symmetric_decrypt(symmetric_key: bytes, ciphertext: bytes):
-    return SecretBox(symmetric_key).decrypt(ciphertext)
+    return b''.join(symmetric_decrypt_stream(symmetric_key, BytesIO(ciphertext)))
+
+
+# 分块流式加密格式：
+# 头部依次为 魔数(8) 版本(1) 标志(1) 保留(2) 分块大小(4) 明文大小(8) nonce前缀(16)，
+# 之后是若干个密文块，每块为 SecretBox 的 MAC(16) + 密文，不单独存储 nonce。
+# 第 i 块的 nonce 为 nonce前缀 + 8 字节大端序号 i，最后一块的序号最高位置 1，
+# 这样截断、重排或丢弃末尾的块都会导致解密失败。
+STREAM_MAGIC = b'CUCSTRM\x00'
+STREAM_VERSION = 1
+STREAM_HEADER = struct.Struct('>8sBBHIQ16s')
+STREAM_NONCE_PREFIX_SIZE = SecretBox.NONCE_SIZE - 8
+STREAM_FINAL_FLAG = 1 << 63
+# 标志位：明文先经过 zlib 压缩再分块加密。
+# 这时头部中的明文大小仍是原文件的大小，头部之后紧跟 8 字节的压缩后数据长度，
+# 块数由压缩后数据的长度推出
+STREAM_FLAG_ZLIB = 1
+STREAM_PAYLOAD_SIZE = struct.Struct('>Q')
+# 压缩前先试压第一块，压缩后不小于原大小的这一比例时不压缩
+COMPRESS_MIN_RATIO = 0.95
+
+
+# 计算第 index 块的 nonce
+
+
+def _chunk_nonce(prefix: bytes, index: int, final: bool):
+    return prefix + struct.pack('>Q', index | (STREAM_FINAL_FLAG if final else 0))
+
+# 从 src 中读满 size 个字节，除非已经读到末尾
+
+
+def _read_full(src, size: int):
+    buf = src.read(size)
+    while buf and len(buf) < size:
+        more = src.read(size - len(buf))
+        if not more:
+            break
+        buf += more
+    return buf
+
+# 各个密文块的 nonce 互不依赖，可以在线程池中并行加密、解密。
+# libsodium 的调用不持有 GIL，多个线程可以同时使用多个 CPU 核心。
+# 每次从流中取出 threads 个块并行处理，再按顺序写出，内存占用为 threads 个块的大小
+
+
+_pools = {}
+_pools_lock = Lock()
+
+
+def _get_pool(threads: int):
+    with _pools_lock:
+        if threads not in _pools:
+            _pools[threads] = ThreadPoolExecutor(
+                threads, thread_name_prefix='crypto')
+        return _pools[threads]
+
+# 对 items 中的每组参数调用 func，按顺序返回结果，threads 大于 1 时在线程池中并行执行
+
+
+def _map_blocks(func, items, threads: int):
+    if threads <= 1 or len(items) <= 1:
+        return [func(*args) for args in items]
+    return list(_get_pool(threads).map(lambda args: func(*args), items))
+
+# 逐块压缩 src 中的明文，提供 read(size) 方法；head 为已经从 src 中读出的第一块
+# size 记录已经读取的明文总长度
+
+
+class _CompressReader:
+
+    def __init__(self, head: bytes, src, level: int):
+        self._pending = head
+        self._src = src
+        self._compressor = zlib.compressobj(level)
+        self._buf = b''
+        self._eof = False
+        self.size = 0
+
+    def read(self, size: int):
+        while len(self._buf) < size and not self._eof:
+            data, self._pending = self._pending or self._src.read(size), b''
+            if data:
+                self.size += len(data)
+                self._buf += self._compressor.compress(data)
+            else:
+                self._buf += self._compressor.flush()
+                self._eof = True
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+# 逐块解压 blocks 产出的压缩数据，每次产出不超过 limit 个字节
+
+
+def _decompress(blocks, limit: int):
+    decompressor = zlib.decompressobj()
+    for block in blocks:
+        while block:
+            data = decompressor.decompress(block, limit)
+            block = decompressor.unconsumed_tail
+            if data:
+                yield data
+    assert decompressor.eof, 'corrupted stream'
+
+# 判断一段数据是否以流式格式的头部开头
+
+
+def is_stream_header(head: bytes):
+    return len(head) >= STREAM_HEADER.size and head[:len(STREAM_MAGIC)] == STREAM_MAGIC
+
+# 从 src 中逐块读取明文，加密后直接写入 dst，内存占用只与分块大小有关
+# dst 需要支持 seek，写完后回填头部中的明文大小；返回明文总长度
+# 传入 signer（StreamSigner）时，边写入边计算密文的签名摘要
+# compress_level 为 1-9 时先用 zlib 压缩明文，第一块压缩效果不明显时自动跳过压缩
+
+
+def symmetric_encrypt_stream(symmetric_key: bytes, src, dst, chunk_size: int, signer=None, threads=None,
+                             compress_level=0):
+    threads = threads or crypto_threads
+    box = SecretBox(symmetric_key)
+    prefix = random(STREAM_NONCE_PREFIX_SIZE)
+    start = dst.tell()
+    chunk, flags, reader = _read_full(src, chunk_size), 0, None
+    if compress_level and chunk and \
+            len(zlib.compress(chunk, compress_level)) < len(chunk) * COMPRESS_MIN_RATIO:
+        flags = STREAM_FLAG_ZLIB
+        reader = src = _CompressReader(chunk, src, compress_level)
+        chunk = _read_full(src, chunk_size)
+    dst.write(STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION,
+                                 flags, 0, chunk_size, 0, prefix))
+    if flags & STREAM_FLAG_ZLIB:
+        dst.write(STREAM_PAYLOAD_SIZE.pack(0))
+    index, total, final = 0, 0, False
+    while not final:
+        batch = []
+        while not final and len(batch) < threads:
+            # 预读下一块，以便确定当前块是否为最后一块
+            next_chunk = _read_full(src, chunk_size) if len(
+                chunk) == chunk_size else b''
+            final = not next_chunk
+            batch.append((chunk, _chunk_nonce(prefix, index, final)))
+            total += len(chunk)
+            chunk, index = next_chunk, index + 1
+        for block in _map_blocks(lambda chunk, nonce: box.encrypt(chunk, nonce).ciphertext,
+                                 batch, threads):
+            dst.write(block)
+            if signer is not None:
+                signer.update(block)
+    end = dst.tell()
+    # 回填明文大小；压缩时还要回填压缩后数据的长度
+    if flags & STREAM_FLAG_ZLIB:
+        head = STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION, flags, 0,
+                                  chunk_size, reader.size, prefix) + STREAM_PAYLOAD_SIZE.pack(total)
+        total = reader.size
+    else:
+        head = STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION,
+                                  0, 0, chunk_size, total, prefix)
+    dst.seek(start)
+    dst.write(head)
+    dst.seek(end)
+    if signer is not None:
+        signer.set_head(head)
+    return total
+
+# 解析流式格式的头部，返回 (分块大小, 明文大小)；不是流式格式时返回 None
+
+
+def stream_header_info(head: bytes):
+    if not is_stream_header(head):
+        return None
+    _, version, _, _, chunk_size, plain_size, _ = STREAM_HEADER.unpack(
+        head[:STREAM_HEADER.size])
+    assert version == STREAM_VERSION, 'unsupported stream version'
+    return chunk_size, plain_size
+
+# 从 src 中逐块读取密文并解密，以生成器的形式逐块产出明文
+# 旧格式的整块 SecretBox 密文无法分块，只能一次性解密后产出
+
+
+def symmetric_decrypt_stream(symmetric_key: bytes, src, threads=None):
+    threads = threads or crypto_threads
+    box = SecretBox(symmetric_key)
+    head = _read_full(src, STREAM_HEADER.size)
+    if not is_stream_header(head):
+        yield box.decrypt(head + src.read())
+        return
+    _, version, flags, _, chunk_size, plain_size, prefix = STREAM_HEADER.unpack(head)
+    assert version == STREAM_VERSION, 'unsupported stream version'
+    payload_size = plain_size
+    if flags & STREAM_FLAG_ZLIB:
+        payload_size, = STREAM_PAYLOAD_SIZE.unpack(
+            _read_full(src, STREAM_PAYLOAD_SIZE.size))
+    # 由明文（压缩时为压缩后数据）大小推出块数，空文件也有一个空的最后一块
+    count = max(1, -(-payload_size // chunk_size))
+
+    def blocks():
+        total = 0
+        for first in range(0, count, threads):
+            batch = [(_read_full(src, chunk_size + SecretBox.MACBYTES),
+                      _chunk_nonce(prefix, index, index == count - 1))
+                     for index in range(first, min(first + threads, count))]
+            for chunk in _map_blocks(box.decrypt, batch, threads):
+                total += len(chunk)
+                yield chunk
+        assert total == payload_size and not src.read(1), 'corrupted stream'
+
+    # 压缩的流边解密边解压
+    chunks = _decompress(blocks(), chunk_size) if flags & STREAM_FLAG_ZLIB else blocks()
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        yield chunk
+    assert total == plain_size, 'corrupted stream'
 
 # 返回私钥的公钥编码
 
 
 def get_pk_raw():
-    return PrivateKey(sk_raw).public_key.encode()
+    return _get_keys().public_key.encode()
+
+# 由服务器私钥派生出一个对称密钥，person 用于区分不同用途（最长16字节）
+
+
+def derive_key(person: bytes):
+    return blake2b(b'', digest_size=SecretBox.KEY_SIZE, key=sk_raw,
+                   person=person, encoder=RawEncoder)
+
+# 用派生密钥加密并认证 payload，得到可以放在 URL 或 Cookie 中的令牌字符串
+
+
+def seal_token(person: bytes, payload: bytes):
+    return SecretBox(derive_key(person)).encrypt(payload, encoder=URLSafeBase64Encoder).decode()
+
+# 还原 seal_token 生成的令牌，令牌被篡改或格式错误时返回 None
+
+
+def open_token(person: bytes, token: str):
+    try:
+        return SecretBox(derive_key(person)).decrypt(token.encode(), encoder=URLSafeBase64Encoder)
+    except (CryptoError, ValueError, TypeError):
+        return None
+
+# 收敛加密：由文件内容的哈希值与服务器密钥派生出文件密钥，
+# 相同内容总是得到相同的密钥，因此全局只需加密、存储一份密文
+
+
+def convergent_key(hash_value: str):
+    return blake2b(hash_value.encode(), digest_size=SecretBox.KEY_SIZE,
+                   key=derive_key(b'convergent'), encoder=RawEncoder)
+
+# 用用户的对称密钥包装（加密）文件密钥
+
+
+def wrap_key(symmetric_key: bytes, file_key: bytes):
+    return SecretBox(symmetric_key).encrypt(file_key)
+
+# 用用户的对称密钥解开包装后的文件密钥
+
+
+def unwrap_key(symmetric_key: bytes, wrapped_key: bytes):
+    return SecretBox(symmetric_key).decrypt(wrapped_key)
 
 # 生成一个新的密钥对，包括私钥（sk）和公钥（public_key）的编码
 
@@ -75,3 +442,46 @@ def get_pk_raw():
 def new_pair():
     sk = PrivateKey.generate()
     return sk.encode(), sk.public_key.encode()
+
+# 只解密明文中 [start, start+length) 的区间，以生成器的形式逐块产出
+# src 需要支持 seek，只读取覆盖该区间的密文块，用于 HTTP Range 下载
+# 旧格式的整块密文只能整体解密后再截取
+
+
+def symmetric_decrypt_range(symmetric_key: bytes, src, start: int, length: int, threads=None):
+    threads = threads or crypto_threads
+    box = SecretBox(symmetric_key)
+    base = src.tell()
+    head = _read_full(src, STREAM_HEADER.size)
+    if not is_stream_header(head):
+        yield box.decrypt(head + src.read())[start:start+length]
+        return
+    _, version, flags, _, chunk_size, plain_size, prefix = STREAM_HEADER.unpack(head)
+    assert version == STREAM_VERSION, 'unsupported stream version'
+    assert 0 <= start and start + length <= plain_size, 'range out of bounds'
+    # 压缩的流无法定位到任意位置，只能从头解压，跳过区间之前的部分
+    if flags & STREAM_FLAG_ZLIB:
+        src.seek(base)
+        for chunk in symmetric_decrypt_stream(symmetric_key, src, threads):
+            if length <= 0:
+                break
+            piece = chunk[start:start+length]
+            start, length = max(0, start - len(chunk)), length - len(piece)
+            if piece:
+                yield piece
+        return
+    count = max(1, -(-plain_size // chunk_size))
+    # 定位到区间起点所在的密文块，last 为区间终点所在的块
+    index = start // chunk_size
+    skip = start - index * chunk_size
+    last = (start + length - 1) // chunk_size
+    src.seek(base + STREAM_HEADER.size + index *
+             (chunk_size + SecretBox.MACBYTES))
+    for first in range(index, last + 1, threads):
+        batch = [(_read_full(src, chunk_size + SecretBox.MACBYTES),
+                  _chunk_nonce(prefix, i, i == count - 1))
+                 for i in range(first, min(first + threads, last + 1))]
+        for chunk in _map_blocks(box.decrypt, batch, threads):
+            piece = chunk[skip:skip+length]
+            skip, length = 0, length - len(piece)
+            yield piece
@@ -0,0 +1,126 @@
+# 同一台主机上多个进程共享的计数器
+# 进程内的缓存（blob_cache.py 的下载缓存、key_cache.py 的密钥缓存）各自统计命中率等信息，
+# 多个 Web 进程的统计信息通过一块内存映射的共享区域汇总，manage.py 中的命令可以直接读取。
+# 修改共享区域要对文件加锁，需要立即生效的计数（例如下载缓存失效的代数）用 add 立即写入；
+# 统计信息用 count 先在进程内累计，每隔 FLUSH_INTERVAL 秒合并写入一次，不会让每次访问都争抢同一把锁。
+# 没有 fcntl 的平台（Windows）不支持共享区域。
+
+
+from threading import Lock
+from time import monotonic
+from os import path, makedirs
+import mmap
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# 进程内累计的计数写入共享区域的间隔（秒）
+FLUSH_INTERVAL = 1.0
+
+
+class SharedCounters:
+    """
+    多个进程共享的计数器，保存在内存映射的文件中（例如 /dev/shm 下的文件）。
+    读取不加锁，修改时对文件加 flock；每个进程在第一次使用时各自打开文件，
+    fork 出的进程不会共用父进程打开的文件（共用时 flock 无法互斥）。
+    flock 不能在同一进程的线程之间互斥，修改时还要持有进程内的锁。
+    add 立即写入；count 先在进程内累计，距上次写入超过 FLUSH_INTERVAL 秒时才合并写入，flush 立即写入累计的值。
+    fields 为各计数器的名称，每个计数器是一个 64 位无符号整数，按顺序存储。
+    """
+
+    def __init__(self, path_: str, fields):
+        self.path = path_
+        self.fields = tuple(fields)
+        self.layout = struct.Struct('<' + 'Q' * len(self.fields))
+        self._pid = None
+        self._fd = None
+        self._map = None
+        self._lock = Lock()
+        # 本进程尚未写入的计数，fork 出的进程丢弃从父进程继承的部分
+        self._pending = {}
+        self._pending_pid = None
+        self._flushed = 0.0
+
+    def _mapped(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    makedirs(path.dirname(self.path) or '.', exist_ok=True)
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                    if os.fstat(fd).st_size < self.layout.size:
+                        os.ftruncate(fd, self.layout.size)
+                    self._fd, self._map = fd, mmap.mmap(fd, self.layout.size)
+                    self._pid = os.getpid()
+        return self._map
+
+    def get(self, name: str):
+        return struct.unpack_from('<Q', self._mapped(), 8 * self.fields.index(name))[0]
+
+    # 给多个计数器加上对应的值
+    def add(self, **values):
+        buf = self._mapped()
+        with self._lock:
+            self._write(buf, values)
+
+    # 在进程内累计计数，距上次写入超过 FLUSH_INTERVAL 秒时合并写入
+    def count(self, **values):
+        buf = self._mapped()
+        with self._lock:
+            if self._pending_pid != os.getpid():
+                self._pending, self._pending_pid, self._flushed = {}, os.getpid(), monotonic()
+            for name, value in values.items():
+                self._pending[name] = self._pending.get(name, 0) + value
+            if monotonic() - self._flushed >= FLUSH_INTERVAL:
+                self._flush(buf)
+
+    # 立即写入本进程累计的计数
+    def flush(self):
+        buf = self._mapped()
+        with self._lock:
+            if self._pending_pid == os.getpid():
+                self._flush(buf)
+
+    # 调用者需持有进程内的锁
+    def _flush(self, buf):
+        pending, self._pending, self._flushed = self._pending, {}, monotonic()
+        self._write(buf, pending)
+
+    # 在文件锁中修改计数器，调用者需持有进程内的锁
+    def _write(self, buf, values):
+        if not values:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            for name, value in values.items():
+                offset = 8 * self.fields.index(name)
+                struct.pack_into('<Q', buf, offset, struct.unpack_from('<Q', buf, offset)[0] + value)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def snapshot(self):
+        return dict(zip(self.fields, self.layout.unpack_from(self._mapped(), 0)))
+
+
+# 打开 path_ 处的共享计数器，未配置路径或平台不支持时返回 None
+
+
+def open_counters(path_, fields):
+    if not path_ or fcntl is None:
+        return None
+    return SharedCounters(path_, fields)
+
+
+def hit_rate(hits: int, misses: int):
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+# 共享区域中所有进程汇总的统计信息，计数器中需要有 hits 与 misses
+def shared_stats(shared: SharedCounters):
+    stats = shared.snapshot()
+    stats['hit_rate'] = hit_rate(stats['hits'], stats['misses'])
+    return stats
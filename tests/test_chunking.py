@@ -0,0 +1,79 @@
+# 基于内容分块的测试：安装了 numpy 时的向量化实现与逐字节计算切出的块必须完全相同，
+# 否则装与没装 numpy 的节点切出不同的块，跨节点的块去重就会失效。
+# pip install numpy pytest，在仓库根目录执行 python -m pytest tests
+
+
+import io
+import os
+import random
+import pytest
+
+pytest.importorskip('numpy')
+
+import chunking
+
+# (最小, 平均, 最大) 块长度，包括默认配置
+SIZES = [(64, 256, 1024), (100, 512, 2000), (2048, 8192, 32768),
+         (16 * 1024, 64 * 1024, 256 * 1024)]
+
+
+class ShortReader(io.BytesIO):
+    """每次最多返回 limit 个字节，模拟网络流的短读"""
+
+    def __init__(self, data, limit):
+        super().__init__(data)
+        self.limit = limit
+
+    def read(self, size=-1):
+        return super().read(self.limit if size < 0 else min(size, self.limit))
+
+
+def cut_lengths(data, sizes, vectorized, src=None):
+    src = src or io.BytesIO(data)
+    if vectorized:
+        chunks = list(chunking._iter_chunks_numpy(src, *sizes))
+    else:
+        numpy, chunking.numpy = chunking.numpy, None
+        try:
+            chunks = list(chunking.iter_chunks(src, *sizes))
+        finally:
+            chunking.numpy = numpy
+    assert b''.join(chunks) == data
+    return [len(chunk) for chunk in chunks]
+
+
+def lengths_for(sizes, total):
+    min_size, avg_size, max_size = sizes
+    return [0, 1, min_size - 1, min_size, min_size + 1, avg_size, max_size - 1, max_size,
+            max_size + 1, 3 * max_size + 17, total]
+
+
+@pytest.mark.parametrize('sizes', SIZES)
+def test_vectorized_cuts_match_bytewise(sizes):
+    rng = random.Random(sum(sizes))
+    total = 8 * sizes[2] + 12345
+    for length in lengths_for(sizes, total):
+        data = rng.randbytes(length)
+        expected = cut_lengths(data, sizes, vectorized=False)
+        assert cut_lengths(data, sizes, vectorized=True) == expected, length
+        assert all(length_ <= sizes[2] for length_ in expected)
+        # 最后一块之外的块都不短于最小块长度
+        assert all(length_ >= sizes[0] for length_ in expected[:-1])
+
+
+@pytest.mark.parametrize('sizes', SIZES[:2])
+def test_low_entropy_and_short_reads(sizes):
+    # 重复内容没有切分点，只能按最大块长度切分；短读不影响切分结果
+    rng = random.Random(7)
+    data = bytes(5 * sizes[2]) + rng.randbytes(4 * sizes[2]) + b'ab' * sizes[2]
+    expected = cut_lengths(data, sizes, vectorized=False)
+    assert cut_lengths(data, sizes, vectorized=True) == expected
+    assert cut_lengths(data, sizes, vectorized=True, src=ShortReader(data, 777)) == expected
+    assert cut_lengths(data, sizes, vectorized=False, src=ShortReader(data, 777)) == expected
+
+
+def test_iter_chunks_uses_vectorized_path():
+    # 最小块长度不小于一个哈希窗口时 iter_chunks 使用 numpy
+    data = os.urandom(50000)
+    assert [len(chunk) for chunk in chunking.iter_chunks(io.BytesIO(data), 64, 256, 1024)] == \
+        cut_lengths(data, (64, 256, 1024), vectorized=False)
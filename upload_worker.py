@@ -0,0 +1,127 @@
+# 后台上传：config 中 upload_mode = 'background' 时，上传请求只把上传内容暂存（spool）到存储目录下的
+# spool 目录并创建状态为 pending 的文件记录，随后把任务交给本地的进程池；
+# 哈希、加密、签名和写入存储都在进程池中完成，Web 进程只花费接收数据、写入暂存文件的时间，
+# 加密吞吐量随 CPU 核心数增加，与 HTTP 服务器的线程数无关。
+# 暂存的内容用用户的对称密钥流式加密，不以明文落盘（与断点续传暂存的块相同），
+# 并且只允许服务器用户访问（目录权限 0700，文件权限 0600），任务结束后立即删除。
+# 流式加密的开销远小于交给工作进程的哈希、加密与签名；Web 进程重启后也能用用户的密钥解密，完成没有处理完的上传。
+# 每个任务有一个随机的编号，记录在文件记录中，暂存文件也以它命名：
+# 文件在处理期间被删除并重新上传同名文件时，旧任务不会填写新的文件记录。
+
+
+from os import path, makedirs, remove
+from threading import Lock
+import os
+from config import storage_path
+from common import eprint
+
+# 暂存上传内容的目录
+SPOOL_PATH = storage_path + 'spool/'
+
+_pool = None
+_pool_lock = Lock()
+# 工作进程中使用的应用对象，由 _init_worker 创建
+_worker_app = None
+
+
+# 新任务的编号
+def new_job():
+    from uuid import uuid4
+    return uuid4().hex
+
+
+# 任务暂存文件的路径：用户ID/任务编号，manage.py resume-uploads 据文件记录中的任务编号找回暂存的数据
+def spool_path_for(user_id, job):
+    return '{}{}/{}'.format(SPOOL_PATH, user_id, job)
+
+
+# 把 data 中的明文用 symmetric_key 流式加密，暂存为任务 job 的暂存文件，返回暂存文件的路径。
+# 文件创建时就只有服务器用户可以读写，写入失败时删除
+def spool_upload(user_id, job, data, symmetric_key):
+    from config import stream_chunk_size
+    import secret
+    spool_path = spool_path_for(user_id, job)
+    makedirs(path.dirname(spool_path), mode=0o700, exist_ok=True)
+    fd = os.open(spool_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with open(fd, 'wb') as f:
+            secret.symmetric_encrypt_stream(symmetric_key, data, f, stream_chunk_size)
+    except Exception:
+        remove(spool_path)
+        raise
+    return spool_path
+
+
+class SpoolReader:
+    """
+    打开暂存文件并用 symmetric_key 逐块解密，提供 File.upload_file 需要的 filename 属性与 read、seek 方法。
+    upload_file 读完一遍计算哈希后会回到开头再读一遍，因此只支持 seek(0)，回到开头时重新逐块解密。
+    """
+
+    def __init__(self, spool_path, filename, symmetric_key):
+        self.filename = filename
+        self._file = open(spool_path, 'rb')
+        self._key = symmetric_key
+        self.seek(0)
+
+    def seek(self, offset):
+        import secret
+        from common import IterReader
+        assert offset == 0, 'spooled upload can only be rewound'
+        self._file.seek(0)
+        self._reader = IterReader(secret.symmetric_decrypt_stream(self._key, self._file))
+
+    def read(self, size=-1):
+        return self._reader.read(size)
+
+    def close(self):
+        self._file.close()
+
+
+# 工作进程的初始化函数：用 Web 应用的数据库配置创建一个只用于访问数据库的应用对象
+def _init_worker(app_config):
+    global _worker_app
+    from flask import Flask
+    from database import db
+    _worker_app = Flask('upload_worker')
+    _worker_app.config.update(app_config)
+    db.init_app(_worker_app)
+
+
+# 在工作进程中执行的任务：完成暂存文件的哈希、加密、签名与存储，最后删除暂存文件
+def process_upload(user_id, filename, job, ticket=None):
+    from models import File, User
+    spool_path = spool_path_for(user_id, job)
+    with _worker_app.app_context():
+        reader = SpoolReader(spool_path, filename, User.get_by(id_=user_id).get_symmetric_key())
+        try:
+            File.complete_pending(user_id, filename, job, reader, ticket)
+        finally:
+            reader.close()
+            remove(spool_path)
+
+
+# 任务结束时在 Web 进程中记录异常
+def _log_failure(future):
+    if future.exception() is not None:
+        eprint('background upload failed: {!r}'.format(future.exception()))
+
+
+# 把任务交给进程池。进程池在第一次使用时创建，
+# 使用 spawn 方式启动工作进程，不继承 Web 进程中的线程与数据库连接
+def submit_upload(user_id, filename, job, ticket=None):
+    global _pool
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+    from flask import current_app
+    from config import upload_workers
+
+    with _pool_lock:
+        if _pool is None:
+            app_config = dict((k, v) for k, v in current_app.config.items()
+                              if k.startswith('SQLALCHEMY_'))
+            _pool = ProcessPoolExecutor(upload_workers or None, mp_context=get_context('spawn'),
+                                        initializer=_init_worker, initargs=(app_config,))
+    future = _pool.submit(process_upload, user_id, filename, job, ticket)
+    future.add_done_callback(_log_failure)
+    return future
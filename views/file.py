@@ -8,14 +8,33 @@ file.py 是一个 Flask 蓝图（Blueprint）模块，包含了与文件操作
 
 
 # 导入需要的模块和函数
-from flask import Blueprint, render_template, flash, redirect, request
-from models import File
+from flask import Blueprint, render_template, flash, redirect, request, jsonify
+from werkzeug.exceptions import RequestEntityTooLarge
+from models import File, UploadSession
 from common import *
 
 
 # 创建名为 'file' 的 Flask 蓝图
 file = Blueprint('file', __name__)
 
+# 在验证登录、解析请求体之前检查请求声明的 Content-Length，超过上限的请求直接拒绝
+@file.before_request
+def check_content_length():
+    if request.content_length is not None and request.max_content_length is not None \
+            and request.content_length > request.max_content_length:
+        raise RequestEntityTooLarge()
+
+# 请求体或上传文件过大（413）时，提示上传失败并返回文件列表页面；预检查请求返回 JSON
+@file.errorhandler(RequestEntityTooLarge)
+def request_entity_too_large(e):
+    from config import max_upload_size
+    message = 'file too large (>={}B)'.format(max_upload_size)
+    # 只有表单上传返回页面，其余接口返回 JSON
+    if request.path != '/file/upload':
+        return jsonify(status='error', message=message), 413
+    flash('上传失败！' + message)
+    return redirect('/file')
+
 # 定义处理根路由（'/file'）的视图函数，用于展示当前用户上传的文件列表
 @file.route('/')
 @login_required
@@ -55,7 +74,8 @@ def post__upload(user):
         data = form.file.data
 
         # 调用 File 模型的 upload_file 方法，将文件上传到数据库
-        File.upload_file(user, data)
+        # 如果页面脚本已经做过秒传预检查，同时传入上传凭证
+        File.upload_file(user, data, form.ticket.data)
 
         # 如果上传成功，显示上传成功的提示信息
         flash('上传成功！')
@@ -68,6 +88,126 @@ def post__upload(user):
     # 无论上传成功或失败，都重定向到文件列表页面
     return redirect('/file')
 
+# 定义处理 '/upload_batch' POST 请求的视图函数，一次请求上传多个文件，
+# 返回 JSON，逐个列出每个文件是否上传成功及失败原因
+@file.route('/upload_batch', methods=['POST'])
+@login_required
+def post__upload_batch(user):
+    try:
+        # 导入 BatchUploadForm 表单类
+        from form import BatchUploadForm
+        from config import max_batch_files
+
+        form = BatchUploadForm()
+        assert form.is_submitted() and form.validate(), 'invalid form fields'
+
+        # 忽略没有选择文件时浏览器提交的空文件字段
+        files = [data for data in form.files.data or [] if data and data.filename]
+        assert files, 'no file selected'
+        assert len(files) <= max_batch_files, 'too many files (>{})'.format(
+            max_batch_files)
+
+        results = File.upload_files(user, files)
+        return jsonify(status='done', results=[
+            dict(filename=filename, status='error' if error else 'ok', message=error)
+            for filename, error in results])
+
+    except AssertionError as e:
+        message = e.args[0] if len(e.args) else str(e)
+        return jsonify(status='error', message=message), 400
+
+# 定义处理 '/precheck' POST 请求的视图函数，用于文件秒传的预检查
+# 客户端提交哈希值、文件名和大小，服务器已有相同内容时直接完成上传，否则返回上传凭证
+@file.route('/precheck', methods=['POST'])
+@login_required
+def post__precheck(user):
+    try:
+        # 导入 PrecheckForm 表单类
+        from form import PrecheckForm
+
+        # 创建表单对象并验证提交的数据
+        form = PrecheckForm()
+        assert form.is_submitted() and form.validate(), 'invalid form fields'
+
+        # 调用 File 模型的 precheck 方法
+        ticket = File.precheck(user, form.filename.data,
+                               form.hash_value.data.lower(), form.size.data)
+
+        # 服务器已有相同内容，秒传成功
+        if ticket is None:
+            flash('秒传成功！')
+            return jsonify(status='exists')
+
+        # 需要上传文件内容，返回上传凭证
+        return jsonify(status='upload', ticket=ticket)
+
+    except AssertionError as e:
+        # 如果预检查失败，返回具体错误信息
+        message = e.args[0] if len(e.args) else str(e)
+        return jsonify(status='error', message=message), 400
+
+# 以下为断点续传接口，均返回 JSON：
+# POST /upload_session 创建上传会话，返回会话ID、分块大小与块数
+# PUT /upload_session/<会话ID>/<块编号> 请求体为该块的内容，块可以按任意顺序上传，重复上传会覆盖
+# GET /upload_session/<会话ID> 返回已收到的块的编号，连接中断后据此只上传缺少的块
+# POST /upload_session/<会话ID>/finalize 所有块都收到后完成上传
+@file.route('/upload_session', methods=['POST'])
+@login_required
+def post__upload_session(user):
+    try:
+        # 导入 UploadSessionForm 表单类
+        from form import UploadSessionForm
+
+        form = UploadSessionForm()
+        assert form.is_submitted() and form.validate(), 'invalid form fields'
+        session = UploadSession.create(user, form.filename.data, form.size.data,
+                                       form.ticket.data)
+        return jsonify(status='created', session=session.id_,
+                       chunk_size=session.chunk_size, count=session.count)
+
+    except AssertionError as e:
+        message = e.args[0] if len(e.args) else str(e)
+        return jsonify(status='error', message=message), 400
+
+@file.route('/upload_session/<session_id>')
+@login_required
+def get__upload_session(user, session_id):
+    try:
+        session = UploadSession.get_for(user, session_id)
+        return jsonify(status='pending', chunk_size=session.chunk_size,
+                       count=session.count, received=session.received())
+
+    except AssertionError as e:
+        message = e.args[0] if len(e.args) else str(e)
+        return jsonify(status='error', message=message), 404
+
+@file.route('/upload_session/<session_id>/<int:index>', methods=['PUT'])
+@login_required
+def put__upload_session_chunk(user, session_id, index):
+    try:
+        session = UploadSession.get_for(user, session_id)
+
+        # 最多读取分块大小加一个字节，多出的部分说明块的长度不对
+        session.put_chunk(user, index, request.stream.read(session.chunk_size + 1))
+        return jsonify(status='received', index=index)
+
+    except AssertionError as e:
+        message = e.args[0] if len(e.args) else str(e)
+        return jsonify(status='error', message=message), 400
+
+@file.route('/upload_session/<session_id>/finalize', methods=['POST'])
+@login_required
+def post__upload_session_finalize(user, session_id):
+    try:
+        session = UploadSession.get_for(user, session_id)
+        session.finalize(user)
+        flash('上传成功！')
+        return jsonify(status='done')
+
+    except AssertionError as e:
+        message = e.args[0] if len(e.args) else str(e)
+        return jsonify(status='error', message=message), 400
+
 # 定义处理 '/remove' 路由的视图函数，用于处理删除文件的逻辑
 @file.route('/remove')
 @login_required
@@ -93,6 +233,23 @@ def get__remove(user):
     # 无论删除成功或失败，都重定向到文件列表页面
     return redirect('/file')
 
+# 定义处理 '/export' 路由的视图函数，把多个文件打包成 ZIP 压缩包下载
+# 参数 filename 可以重复出现，不指定时导出所有文件；type 为 encrypted（密文与签名）或 plaintext（明文）
+@file.route('/export')
+@login_required
+def get__export(user):
+    try:
+        filenames = request.args.getlist('filename')
+        type_ = request.args.get('type')
+        assert type_ in ('encrypted', 'plaintext'), 'unknown type'
+        return File.export_files(user, filenames, type_)
+
+    except AssertionError as e:
+        message = e.args[0] if len(e.args) else str(e)
+        flash('导出失败！' + message)
+
+    return redirect('/file')
+
 # 定义处理 '/download' 路由的视图函数，用于处理下载文件的逻辑
 @file.route('/download')
 @login_required
@@ -6,7 +6,7 @@ logout.py 是一个 Flask 蓝图（Blueprint）模块，包含与用户登出（
 
 在登出过程中，首先从请求的 cookies 中获取 token，
 然后调用 OnlineUser 模型的 verify_token 方法来验证 token 是否有效。
-如果 token 有效，则通过调用 OnlineUser 模型的 delete_record 方法删除对应的在线用户记录，
+如果 token 有效，则通过调用 OnlineUser 模型的 revoke_record 方法作废该令牌（删除对应的在线用户记录），
 然后返回登出页面。如果 token 无效，则说明用户未登录或登录已经过期，
 将会重定向到登录页面 '/login'。这样确保用户只能登出其自身的在线会话。
 
@@ -32,9 +32,9 @@ def get__logout():
     # 调用 OnlineUser 模型的 verify_token 方法，验证 token 是否有效
     record = OnlineUser.verify_token(token)
 
-    # 如果 token 有效，删除对应的在线用户记录，并返回登出页面
+    # 如果 token 有效，作废该令牌（删除对应的在线用户记录），并返回登出页面
     if record:
-        OnlineUser.delete_record(record.id_)
+        OnlineUser.revoke_record(record)
         return render_template('logout.html')
     else:
         # 如果 token 无效，则重定向到登录页面
@@ -11,6 +11,8 @@ public_key 视图函数用于获取公钥并提供下载。
 它调用 secret 模块的 get_pk_raw 函数来获取公钥的原始数据，
 并通过 make_response 创建一个带有公钥数据的响应对象。
 然后，设置响应头的 Content-Disposition，指定文件名为 public_key，以便客户端进行公钥的下载。
+公钥在更换服务器密钥之前不会改变，响应带有由公钥指纹派生的 ETag，并允许反向代理缓存，
+客户端重新验证时返回 304。
 """
 
 
@@ -37,12 +39,20 @@ def index():
 def public_key():
     # 导入 secret 模块，用于获取公钥原始数据
     from secret import get_pk_raw
+    from config import public_key_cache_max_age
 
     # 调用 get_pk_raw 函数，获取公钥原始数据
-    response = make_response(get_pk_raw())
+    pk = get_pk_raw()
+
+    # 公钥的指纹作为 ETag，客户端已有同一公钥时返回 304
+    etag = content_etag('public_key', pk)
+    response = not_modified(etag, public_key_cache_max_age, public=True)
+    if response is not None:
+        return response
+    response = make_response(pk)
 
     # 设置响应头的 Content-Disposition，指定文件名为 'public_key'，以便客户端下载
     response.headers['Content-Disposition'] = 'attachment; filename=public_key'
 
-    # 返回带有公钥数据的响应对象
-    return response
+    # 返回带有公钥数据与缓存头部的响应对象
+    return set_cache_headers(response, etag, public_key_cache_max_age, public=True)
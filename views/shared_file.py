@@ -8,7 +8,7 @@ get__ 视图函数用于显示共享的文件列表。它查询所有已共享
 然后，将文件名和对应的创建者用户名组合成一个列表，传递给 shared_file.html 模板进行渲染。
 
 get__download 视图函数用于下载共享文件。它从请求参数中获取文件名、用户名和类型，
-然后根据用户名查询用户对象，并调用 File 模型的 download_file 方法来下载共享文件。
+然后调用 File 模型的 download_shared 方法来下载共享文件，热门的共享文件直接从缓存中返回。
 如果下载失败，则在页面上显示相应的错误提示信息，并重定向到共享文件列表页面。
 
 """
@@ -42,8 +42,8 @@ def get__():
 # 定义处理 '/download' 路由的视图函数，用于下载共享文件
 @shared_file.route('/download')
 def get__download():
-    # 导入 User 和 File 模型
-    from models import User, File
+    # 导入 File 模型
+    from models import File
 
     try:
         # 从请求参数中获取文件名、用户名和类型
@@ -55,11 +55,8 @@ def get__download():
         assert type_, 'missing type'
         assert type_ in ('encrypted', 'signature'), 'unknown type'
 
-        # 根据用户名查询用户对象
-        user = User.get_by(username=username)
-
-        # 调用 File 模型的 download_file 方法，下载共享文件
-        return File.download_file(user, filename, type_)
+        # 调用 File 模型的 download_shared 方法，下载共享文件
+        return File.download_shared(username, filename, type_)
 
     except AssertionError as e:
         # 如果下载失败，获取异常消息，并将消息传递给 flash 进行显示